@@ -0,0 +1,307 @@
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from database import database, Showtime, Film, migrate, purge_old_records
+from showtime_index import ShowtimeIndex
+from datetime import datetime, timedelta
+
+
+def _timed(f):
+    start = time.perf_counter()
+    value = f()
+    return (time.perf_counter() - start, value)
+
+
+# Fills the database with `showtimes_count` synthetic showtimes spread across `films_count` films, 10
+# theatres, and dates from `past_days` days in the past to 90 days in the future.
+def _generate_showtimes(showtimes_count, films_count, past_days):
+    rng = random.Random(0)
+    theatres = [f'theatre-{i}' for i in range(10)]
+    start = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=past_days)
+    minutes = (past_days + 90) * 24 * 60
+
+    with database.atomic():
+        Film.insert_many([(f'film-{i}', f'Film {i}') for i in range(films_count)],
+                         fields=[Film.key, Film.title]).execute()
+
+    generated = set()
+    rows = []
+    while len(generated) < showtimes_count:
+        row = (f'film-{rng.randrange(films_count)}',
+               rng.choice(theatres),
+               start + timedelta(minutes=rng.randrange(minutes // 5) * 5))
+        if row in generated:
+            continue
+        generated.add(row)
+        rows.append(row + ('https://www.amctheatres.com/showtimes/0',))
+
+        if len(rows) == 10000 or len(generated) == showtimes_count:
+            with database.atomic():
+                Showtime.insert_many(rows, fields=[Showtime.film, Showtime.theatre, Showtime.date, Showtime.link]).execute()
+            rows = []
+
+    return list(generated)
+
+
+# Times showtime lookups and purge_old_records on a database with `showtimes_count` synthetic showtimes,
+# both with the original schema and with the current migrations applied.
+def benchmark_database(showtimes_count, films_count=2000, lookups=1000, past_days=7):
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for (name, to_version) in [('original schema', 1), ('migrated', None)]:
+            database.init(os.path.join(directory, f'bench-{to_version}.db'))
+            with database:
+                migrate(to_version=1)
+                (generate_time, showtimes) = _timed(lambda: _generate_showtimes(showtimes_count, films_count, past_days))
+                (migrate_time, _) = _timed(lambda: migrate(to_version=to_version))
+
+                sample = random.Random(1).sample(showtimes, min(lookups, len(showtimes)))
+                (lookup_time, _) = _timed(lambda: [Showtime.get_or_none(film=f, theatre=t, date=d) for (f, t, d) in sample])
+                (purge_time, purged) = _timed(purge_old_records)
+
+            results.append((name, generate_time, migrate_time, lookup_time / len(sample), purge_time, purged))
+    finally:
+        shutil.rmtree(directory)
+
+    body = f"Database benchmark with {showtimes_count} showtimes and {films_count} films\n"
+    for (name, generate_time, migrate_time, lookup_time, purge_time, purged) in results:
+        body += f"  {name}\n"
+        body += f"    generate: {generate_time:.2f}s, migrate: {migrate_time:.2f}s\n"
+        body += f"    lookup: {lookup_time * 1000:.3f}ms per showtime\n"
+        body += f"    purge: {purge_time:.2f}s ({purged.showtimes} showtimes, {purged.films} films)\n"
+    return body
+
+
+# Measures how long it takes to load the ShowtimeIndex for a database with `showtimes_count` synthetic
+# showtimes, how much memory it uses and how fast showtimes can be diffed against it.
+def benchmark_showtime_index(showtimes_count, films_count=2000, lookups=100000):
+    directory = tempfile.mkdtemp()
+    try:
+        database.init(os.path.join(directory, 'bench-index.db'))
+        with database:
+            migrate()
+            showtimes = _generate_showtimes(showtimes_count, films_count, 0)
+
+            (load_time, index) = _timed(lambda: ShowtimeIndex().load())
+
+            # Load again to measure memory, tracing allocations slows loading down considerably
+            index = None
+            tracemalloc.start()
+            index = ShowtimeIndex().load()
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            sample = random.Random(1).sample(showtimes, min(lookups, len(showtimes)))
+            link = 'https://www.amctheatres.com/showtimes/0'
+            (diff_time, diffs) = _timed(lambda: [index.diff(f, t, d, link) for (f, t, d) in sample])
+    finally:
+        shutil.rmtree(directory)
+
+    body = f"Showtime index benchmark with {showtimes_count} showtimes and {films_count} films\n"
+    body += f"  load: {load_time:.2f}s\n"
+    body += f"  memory: {memory / (1024 * 1024):.1f}MB ({memory / max(1, len(index)):.0f} bytes per showtime)\n"
+    body += f"  diff: {diff_time / len(sample) * 1000000:.2f}us per showtime ({diffs.count(ShowtimeIndex.UNCHANGED)} of {len(sample)} unchanged)\n"
+    return body
+
+
+# Times loading the email templates with and without the bytecode cache, and rendering the text and html
+# showtime outputs for `showtimes_count` synthetic showtimes
+def benchmark_outputs(showtimes_count, films_count=200, theatres_count=10):
+    from jinja2 import Environment
+    from outputs import gen_formated_showtimes, gen_new_showtimes_html, precompile_templates, jinja_env
+
+    precompile_templates()
+    jenv = jinja_env()
+    (compile_time, _) = _timed(lambda: [Environment(loader=jenv.loader).get_template(n) for n in jenv.list_templates()])
+    (cached_compile_time, _) = _timed(lambda: [Environment(loader=jenv.loader, bytecode_cache=jenv.bytecode_cache).get_template(n) for n in jenv.list_templates()])
+
+    rng = random.Random(0)
+    films = [Film(key=f'film-{i}', title=f'Film {i}') for i in range(films_count)]
+    theatres = [f'location/theatre-{i}' for i in range(theatres_count)]
+    start = datetime.combine(datetime.now().date(), datetime.min.time())
+    showtimes = [Showtime(film=rng.choice(films),
+                          theatre=rng.choice(theatres).split('/')[-1],
+                          date=start + timedelta(minutes=rng.randrange(90 * 24 * 12) * 5),
+                          link='https://www.amctheatres.com/showtimes/0')
+                 for _ in range(showtimes_count)]
+
+    (text_time, text) = _timed(lambda: gen_formated_showtimes(showtimes, theatres))
+    (html_time, html) = _timed(lambda: gen_new_showtimes_html(showtimes, theatres))
+    (memoized_html_time, _) = _timed(lambda: gen_new_showtimes_html(showtimes, theatres))
+
+    body = f"Outputs benchmark with {showtimes_count} showtimes, {films_count} films and {theatres_count} theatres\n"
+    body += f"  templates: {compile_time * 1000:.1f}ms to compile, {cached_compile_time * 1000:.1f}ms from the bytecode cache\n"
+    body += f"  text: {text_time:.2f}s ({len(text)} chars)\n"
+    body += f"  html: {html_time:.2f}s ({len(html)} chars), {memoized_html_time:.2f}s again with the film blocks memoized\n"
+    return body
+
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Runs `cycles` full notify runs against a local ReplayServer serving the pages recorded in `pages_dir`, or
+# synthetic pages for `theatres` and `offerings` if no directory is given. `run_notify` is called with the
+# arguments returned by `notify_args(theatres, offerings)`, each run with the database and HTTP cache left by
+# the previous one, so the first run measures a cold start and later runs a steady state of unchanged pages.
+# Reports wall time, requests per second and CPU time of each run, and the peak RSS of the whole benchmark.
+def benchmark_replay(run_notify, notify_args, pages_dir=None, cycles=3, latency=0.05, error_rate=0.0,
+                     theatres=None, offerings=None, retry_after=None, failing_theatres=()):
+    import fetch_showtimes
+    from replay import ReplayServer, recorded_pages
+
+    if pages_dir:
+        pages = recorded_pages(pages_dir)
+        if not pages:
+            raise ValueError(f'No recorded pages found in {pages_dir}')
+        theatres = list(dict.fromkeys(t for (t, o) in pages))
+        offerings = list(dict.fromkeys(o for (t, o) in pages))
+    args = notify_args(theatres, offerings)
+
+    directory = tempfile.mkdtemp()
+    args.report_file = os.path.join(directory, 'run-report.json')
+    results = []
+    try:
+        with ReplayServer(pages_dir, latency, error_rate, retry_after, failing_theatres) as server:
+            fetch_showtimes.set_showtimes_base_url(server.url)
+            fetch_showtimes.http_cache.init(os.path.join(directory, 'http_cache'))
+            database.init(os.path.join(directory, 'bench-replay.db'))
+
+            # Committing every page on its own like notify does
+            with database.connection_context():
+                migrate()
+                for cycle in range(cycles):
+                    requests = server.requests
+                    errors = server.errors
+                    bytes_sent = server.bytes_sent
+                    cpu = _cpu_seconds(resource.RUSAGE_SELF)
+                    children_cpu = _cpu_seconds(resource.RUSAGE_CHILDREN)
+                    start = time.perf_counter()
+
+                    failed = False
+                    try:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            run_notify(args)
+                    except Exception:
+                        failed = True
+                    with open(args.report_file) as f:
+                        counters = json.load(f)['counters']
+
+                    results.append((time.perf_counter() - start,
+                                    server.requests - requests,
+                                    server.errors - errors,
+                                    server.bytes_sent - bytes_sent,
+                                    _cpu_seconds(resource.RUSAGE_SELF) - cpu,
+                                    _cpu_seconds(resource.RUSAGE_CHILDREN) - children_cpu,
+                                    Showtime.select().count(),
+                                    counters.get('exceptions', 0),
+                                    counters.get('deferred_pages', 0),
+                                    failed))
+    finally:
+        fetch_showtimes.set_showtimes_base_url(None)
+        fetch_showtimes.http_cache.init(None)
+        shutil.rmtree(directory)
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    source = f'pages recorded in {pages_dir}' if pages_dir else 'synthetic pages'
+    body = f"Replay benchmark of {cycles} notify runs for {args.lookforward_days} days, {len(theatres)} theatres and {len(offerings)} offerings from {source}\n"
+    body += f"  server latency: {latency * 1000:.0f}ms, error rate: {error_rate:.0%}{f' (429 retry after {retry_after}s)' if retry_after is not None else ''}, failing theatres: {len(failing_theatres)}, concurrency: {args.concurrency}, parse workers: {args.parse_workers}\n"
+    for (i, (wall_time, requests, errors, bytes_sent, cpu, children_cpu, showtimes, exceptions, deferred, failed)) in enumerate(results):
+        body += f"  run {i + 1}{f' ({exceptions} pages failed, {deferred} deferred)' if failed or deferred else ''}\n"
+        body += f"    wall: {wall_time:.2f}s, {requests} requests ({errors} errors), {requests / wall_time:.1f} requests/s, {bytes_sent / 1024:.0f}KiB received\n"
+        body += f"    cpu: {cpu:.2f}s ({cpu / wall_time:.0%} of wall) + {children_cpu:.2f}s in parse workers, {showtimes} showtimes stored\n"
+    body += f"  peak rss: {peak_rss / 1024:.1f}MB, largest child process (parse workers, replay server): {children_peak_rss / 1024:.1f}MB\n"
+    return body
+
+
+# Most time the light commands may take to start on top of starting the interpreter itself
+STARTUP_TARGET_SECONDS = 0.15
+
+# Commands timed by benchmark_startup as (name, arguments to main.py, whether the target applies). {db} is
+# replaced with a temporary database.
+STARTUP_COMMANDS = [
+    ('--help', ['--help'], True),
+    ('email', ['email', '--notification-backend', 'print', 'bench@localhost', '', 'Subject', 'Body', 'bench@localhost'], True),
+    ('debug --print-films', ['--db-file', '{db}', 'debug', '--print-films'], True),
+    ('compile-templates', ['compile-templates'], False),
+    ('fetch --help', ['fetch', '--help'], True),
+]
+
+
+def _run_python(arguments, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + arguments
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0 and not importtime:
+        raise RuntimeError(f'{" ".join(arguments)} failed:\n{completed.stderr}')
+    return (elapsed, completed.stderr)
+
+
+# The top level imports reported by `python -X importtime`, as (module, cumulative seconds) pairs, slowest first
+def _top_level_imports(importtime_output):
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (_, cumulative, name) = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that imported them
+        if not name.startswith('  '):
+            imports.append((name.strip(), int(cumulative) / 1000000))
+    return sorted(imports, key=lambda x: -x[1])
+
+
+# Times cold starts of main.py commands in new processes, `runs` times each keeping the fastest, compared to
+# starting the interpreter alone. Each command is also run once under `python -X importtime` to report the
+# modules it imports that take the longest. Returns the report and whether every light command started within
+# STARTUP_TARGET_SECONDS of the interpreter.
+def benchmark_startup(runs=5, target=STARTUP_TARGET_SECONDS):
+    directory = tempfile.mkdtemp()
+    try:
+        database.init(os.path.join(directory, 'bench-startup.db'))
+        with database:
+            migrate()
+
+        interpreter = min(_run_python(['-c', 'pass'])[0] for _ in range(runs))
+        results = []
+        for (name, arguments, light) in STARTUP_COMMANDS:
+            arguments = ['main.py'] + [a.replace('{db}', os.path.join(directory, 'bench-startup.db')) for a in arguments]
+            elapsed = min(_run_python(arguments)[0] for _ in range(runs))
+            imports = _top_level_imports(_run_python(arguments, importtime=True)[1])
+            results.append((name, light, elapsed, imports))
+
+        # Every module the notifier can import, for reference
+        elapsed = min(_run_python(['-c', 'import main, fetch_showtimes, outputs, outbox, benchmarks'])[0] for _ in range(runs))
+        results.append(('all modules', False, elapsed, []))
+    finally:
+        shutil.rmtree(directory)
+
+    passed = True
+    body = f"Startup benchmark, fastest of {runs} runs, target for light commands: {target * 1000:.0f}ms on top of the interpreter\n"
+    body += f"  interpreter: {interpreter * 1000:.0f}ms\n"
+    for (name, light, elapsed, imports) in results:
+        overhead = elapsed - interpreter
+        status = ''
+        if light:
+            status = ' ok' if overhead <= target else ' OVER TARGET'
+            passed = passed and overhead <= target
+        body += f"  {name}: {elapsed * 1000:.0f}ms (+{overhead * 1000:.0f}ms){status}\n"
+        slowest = [f'{module} {seconds * 1000:.0f}ms' for (module, seconds) in imports if module not in ('site', 'encodings')][:3]
+        if slowest:
+            body += f"    slowest imports: {', '.join(slowest)}\n"
+    return (body, passed)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+
+# Circuit breaker for requests to a single theatre. While closed requests go through, and after
+# `failure_threshold` failures in a row it opens. While open requests are refused, until `reset_seconds` later
+# it becomes half-open and lets a single probe request through. The probe succeeding closes the breaker again,
+# failing opens it for another `reset_seconds`.
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return self.CLOSED
+        if now - self._opened_at < self.reset_seconds:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    # Whether a request may be made now. In the half-open state only the first caller gets to probe.
+    def allow(self):
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    # For a request whose outcome says nothing about the theatre, e.g. when every theatre is being throttled.
+    # If it was the probe, another request may probe instead.
+    def record_ignored(self):
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # Failures of requests still in flight when the breaker opened don't extend the time it is open
+            if self._probing or (self._opened_at is None and self.failures >= self.failure_threshold):
+                self.trips += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+# Keeps a separate CircuitBreaker for every theatre, so failures at one theatre don't hold back the others
+class TheatreCircuitBreakers(object):
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, theatre):
+        with self._lock:
+            breaker = self._breakers.get(theatre)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+                self._breakers[theatre] = breaker
+            return breaker
+
+    # The theatres whose breaker opened at least once
+    def tripped(self):
+        with self._lock:
+            return [t for (t, b) in self._breakers.items() if b.trips > 0]
+
+
+# Limits retries to `minimum` plus `ratio` of the requests made, so that when many requests are failing
+# retrying them doesn't multiply the load and the time spent waiting on backoff.
+class RetryBudget(object):
+
+    def __init__(self, ratio, minimum):
+        self.ratio = ratio
+        self.minimum = minimum
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def available(self):
+        with self._lock:
+            return self.retries < self.minimum + self.ratio * self.requests
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+
+# Keeps a separate RetryBudget for every theatre, so a theatre that keeps failing can't use up the retries of
+# the others
+class TheatreRetryBudgets(object):
+
+    def __init__(self, ratio, minimum):
+        self.ratio = ratio
+        self.minimum = minimum
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def get(self, theatre):
+        with self._lock:
+            budget = self._budgets.get(theatre)
+            if budget is None:
+                budget = RetryBudget(self.ratio, self.minimum)
+                self._budgets[theatre] = budget
+            return budget
+
+    def reset(self):
+        with self._lock:
+            self._budgets = {}
@@ -1,5 +1,48 @@
 FETCH_DELAY=5
-MAX_EXCEPTIONS=5
+# Average requests per second allowed against a single host. Defaults to the same budget as the old fixed FETCH_DELAY sleep.
+FETCH_RATE=1.0 / FETCH_DELAY
+# Number of requests that may be queued up at the rate limiter at once (token bucket size).
+FETCH_BURST=1
+# Number of requests that may be in flight at once.
+FETCH_CONCURRENCY=4
+# Number of processes used to parse pages, 0 parses them on a single thread in this process instead.
+PARSE_WORKERS=0
+# Maximum number of pages waiting between each stage of the fetch pipeline.
+PIPELINE_QUEUE_SIZE=16
+# Maximum number of keep-alive connections kept open to a single host.
+HTTP_POOL_SIZE=16
+# Attempts made for a page request, with exponential backoff of FETCH_RETRY_FACTOR seconds between them.
+FETCH_RETRY_TRIES=3
+FETCH_RETRY_FACTOR=2
+# Retries allowed per theatre per run: a minimum plus a fraction of the requests made to the theatre, so widespread
+# failures aren't multiplied and a failing theatre can't use up the retries of the others.
+FETCH_RETRY_BUDGET_MIN=5
+FETCH_RETRY_BUDGET_RATIO=0.1
+# Longest Retry-After in seconds that is waited out. A longer one stops the run and defers the remaining pages.
+FETCH_MAX_RETRY_AFTER=60
+# Failed requests in a row at a theatre before its circuit breaker opens and its pages are deferred to the next run.
+CIRCUIT_FAILURE_THRESHOLD=3
+# Seconds a theatre's circuit breaker stays open before a single request is let through to probe it.
+CIRCUIT_RESET_SECONDS=60
+# Parser backend used to extract showtimes from pages, one of HTML_PARSERS (the keys of fetch_showtimes.PARSERS).
+HTML_PARSER='strainer'
+HTML_PARSERS=['html5lib', 'strainer']
 BASE_URL='https://www.amctheatres.com'
-THEATRE_SHOWTIMES_URL=BASE_URL + '/movie-theatres/{location}/{theatre_key}/showtimes/all/{datestr}/{theatre_key}/{offering}'
-
+# Path of a theatre's showtimes page, requested from BASE_URL unless another base URL is given (e.g. a replay server).
+THEATRE_SHOWTIMES_PATH='/movie-theatres/{location}/{theatre_key}/showtimes/all/{datestr}/{theatre_key}/{offering}'
+THEATRE_SHOWTIMES_URL=BASE_URL + THEATRE_SHOWTIMES_PATH
+# Polling intervals used by the adaptive scan schedule as (days away, hours between fetches) pairs. A page is
+# polled with the interval of the first pair whose days away is at least as far as the page's date.
+SCAN_INTERVALS=[(7, 0), (14, 6), (30, 12), (60, 24), (None, 72)]
+# Pages that changed within this many hours are polled at a quarter of their usual interval.
+SCAN_RECENT_CHANGE_HOURS=72
+# Minutes between the start of each run in serve mode.
+SERVE_INTERVAL_MINUTES=360
+# Where notifications are delivered, see notifications.create_backend for the supported values.
+NOTIFICATION_BACKEND='gmail'
+# Number of times delivering a notification is attempted, across runs, before it is dropped from the outbox.
+NOTIFICATION_MAX_ATTEMPTS=5
+# Directory the compiled email templates are cached in, relative to the app directory unless absolute.
+TEMPLATE_CACHE_DIR='template_cache'
+# Number of rendered film blocks kept for reuse by the html email.
+HTML_FILM_CACHE_SIZE=1024
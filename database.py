@@ -1,8 +1,15 @@
 from datetime import datetime
-from peewee import SqliteDatabase, Model, CharField, DateTimeField, ForeignKeyField
+from peewee import fn, SqliteDatabase, Model, BooleanField, CharField, DateTimeField, ForeignKeyField, IntegerField, TextField
 
 
-database = SqliteDatabase(None)
+database = SqliteDatabase(None, pragmas={
+    # WAL lets readers work alongside the writer and needs far fewer fsyncs per commit
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # Negative values are in KiB, so a 16MB page cache
+    'cache_size': -16 * 1024,
+    'temp_store': 'memory',
+})
 
 
 class BaseModel(Model):
@@ -18,28 +25,151 @@ class Film(BaseModel):
 class Showtime(BaseModel):
     film = ForeignKeyField(Film, backref='showtimes')
     theatre = CharField()
-    date = DateTimeField()
+    date = DateTimeField(index=True)
     link = CharField()
 
+    class Meta:
+        indexes = (
+            (('film', 'theatre', 'date'), True),
+        )
+
+
+# Fingerprint of the last processed content of a showtimes page, used to skip pages that haven't changed.
+# theatre is in the "location/theatre_key" format and date is the requested date string (e.g. 2023-08-05).
+class PageFingerprint(BaseModel):
+    theatre = CharField()
+    offering = CharField()
+    date = CharField()
+    body_hash = CharField(null=True)
+    result_hash = CharField()
+
+    class Meta:
+        indexes = (
+            (('theatre', 'offering', 'date'), True),
+        )
+
+
+# When a showtimes page was last fetched and last found to have changed, used to schedule how often the
+# page is fetched. theatre and date are in the same format as PageFingerprint.
+class ScanState(BaseModel):
+    theatre = CharField()
+    offering = CharField()
+    date = CharField()
+    last_checked = DateTimeField()
+    last_changed = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('theatre', 'offering', 'date'), True),
+        )
+
+
+# A notification that has not been delivered yet, kept so that it can be retried on a later run if sending
+# fails or the process exits first. recipients is a JSON list and attachments a JSON list of [filename,
+# content] pairs.
+class Outbox(BaseModel):
+    created = DateTimeField()
+    subject = CharField()
+    body = TextField()
+    html = BooleanField()
+    recipients = TextField()
+    attachments = TextField()
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+
+# Schema migrations, applied in order by migrate(). The number of applied migrations is stored in the
+# database's user_version. Migrations use plain SQL so that they keep working as the models above change.
+
+def _create_film_and_showtime_tables():
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "film" ("key" VARCHAR(255) NOT NULL PRIMARY KEY, "title" VARCHAR(255) NOT NULL)')
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "showtime" ("id" INTEGER NOT NULL PRIMARY KEY, "film_id" VARCHAR(255) NOT NULL, "theatre" VARCHAR(255) NOT NULL, "date" DATETIME NOT NULL, "link" VARCHAR(255) NOT NULL, FOREIGN KEY ("film_id") REFERENCES "film" ("key"))')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "showtime_film_id" ON "showtime" ("film_id")')
+
+
+def _add_showtime_indexes():
+    # Older databases could contain duplicate showtimes, keep the first one so the unique index can be created
+    database.execute_sql('DELETE FROM "showtime" WHERE "id" NOT IN (SELECT MIN("id") FROM "showtime" GROUP BY "film_id", "theatre", "date")')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "showtime_film_id_theatre_date" ON "showtime" ("film_id", "theatre", "date")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "showtime_date" ON "showtime" ("date")')
+
+
+def _create_page_fingerprint_table():
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "pagefingerprint" ("id" INTEGER NOT NULL PRIMARY KEY, "theatre" VARCHAR(255) NOT NULL, "offering" VARCHAR(255) NOT NULL, "date" VARCHAR(255) NOT NULL, "body_hash" VARCHAR(255), "result_hash" VARCHAR(255) NOT NULL)')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "pagefingerprint_theatre_offering_date" ON "pagefingerprint" ("theatre", "offering", "date")')
+
+
+def _create_scan_state_table():
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "scanstate" ("id" INTEGER NOT NULL PRIMARY KEY, "theatre" VARCHAR(255) NOT NULL, "offering" VARCHAR(255) NOT NULL, "date" VARCHAR(255) NOT NULL, "last_checked" DATETIME NOT NULL, "last_changed" DATETIME)')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "scanstate_theatre_offering_date" ON "scanstate" ("theatre", "offering", "date")')
+
+
+def _create_outbox_table():
+    database.execute_sql('CREATE TABLE IF NOT EXISTS "outbox" ("id" INTEGER NOT NULL PRIMARY KEY, "created" DATETIME NOT NULL, "subject" VARCHAR(255) NOT NULL, "body" TEXT NOT NULL, "html" INTEGER NOT NULL, "recipients" TEXT NOT NULL, "attachments" TEXT NOT NULL, "attempts" INTEGER NOT NULL, "last_error" TEXT)')
+
+
+MIGRATIONS = [
+    _create_film_and_showtime_tables,
+    _add_showtime_indexes,
+    _create_page_fingerprint_table,
+    _create_scan_state_table,
+    _create_outbox_table,
+]
+
+
+def schema_version():
+    return database.pragma('user_version')
+
+
+# Applies any migrations that haven't been applied yet, up to and including migration number `to_version`
+# (all of them by default). Returns the number of migrations applied.
+def migrate(to_version=None):
+    if to_version is None:
+        to_version = len(MIGRATIONS)
+
+    version = schema_version()
+    for i in range(version, to_version):
+        with database.atomic():
+            MIGRATIONS[i]()
+            database.pragma('user_version', i + 1)
+
+    return max(0, to_version - version)
+
 
 class PurgeOldRecordsResult(object):
 
     def __init__(self):
         self.showtimes = 0
         self.films = 0
+        self.pages = 0
 
 
-# Removes Showtimes with date older than the current date and Films with no showtimes.
+# Forgets every page fingerprint and scan state so that all pages are fetched and processed again on the next
+# run. Needed whenever showtimes are changed outside of a notify run, otherwise unchanged pages would never
+# restore them.
+def clear_page_state():
+    ScanState.delete().execute()
+    return PageFingerprint.delete().execute()
+
+
+# Removes Showtimes with date older than the current date, Films with no showtimes and the fingerprints and
+# scan states of pages for past dates. All are done as single set based deletes in one transaction, comparing the date column directly so the date index is used.
 def purge_old_records():
     d = datetime.combine(datetime.now().date(), datetime.min.time())
 
     result = PurgeOldRecordsResult()
 
-    q = Showtime.delete().where(Showtime.date.truncate('day') < d)
-    result.showtimes = q.execute()
+    with database.atomic():
+        q = Showtime.delete().where(Showtime.date < d)
+        result.showtimes = q.execute()
+
+        q = Film.delete().where(~fn.EXISTS(Showtime.select(Showtime.id).where(Showtime.film == Film.key)))
+        result.films = q.execute()
+
+        q = PageFingerprint.delete().where(PageFingerprint.date < d.strftime('%Y-%m-%d'))
+        result.pages = q.execute()
 
-    for film in Film.select():
-        if film.showtimes.count() == 0:
-            result.films += film.delete_instance()
+        q = ScanState.delete().where(ScanState.date < d.strftime('%Y-%m-%d'))
+        q.execute()
 
     return result
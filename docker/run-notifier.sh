@@ -4,10 +4,12 @@ cd /app
 
 python main.py \
   --db-file /data/amc_showtimes.db \
+  --http-cache-dir /data/http_cache \
   notify \
   $LOOKAHEAD_DAYS \
   $EMAIL_SENDER \
   $SMTP_PASSWORD \
   --email-to $EMAIL_RECIPIENTS \
   --theatres $THEATRES \
-  --offerings $OFFERINGS
+  --offerings $OFFERINGS \
+  --notification-backend $NOTIFICATION_BACKEND
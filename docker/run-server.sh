@@ -0,0 +1,16 @@
+#!/bin/sh
+
+cd /app
+
+exec python -u main.py \
+  --db-file /data/amc_showtimes.db \
+  --http-cache-dir /data/http_cache \
+  serve \
+  $LOOKAHEAD_DAYS \
+  $EMAIL_SENDER \
+  $SMTP_PASSWORD \
+  --email-to $EMAIL_RECIPIENTS \
+  --theatres $THEATRES \
+  --offerings $OFFERINGS \
+  --notification-backend $NOTIFICATION_BACKEND \
+  --interval-minutes $SERVE_INTERVAL_MINUTES
@@ -62,6 +62,12 @@ usermod --uid "$PUID" --gid "$PGID" --non-unique "$PUSER" > /dev/null
 export PUSER
 export PGROUP
 /var/local/bin/configure-app.sh
+
+if [ "$RUN_MODE" = "serve" ]; then
+  # Replace this shell so the notifier receives SIGTERM directly when the container stops
+  exec su-exec "$PUSER":"$PGROUP" /var/local/bin/run-server.sh
+fi
+
 /var/local/bin/configure-cron.sh
 
 # Get existing number of lines in the log
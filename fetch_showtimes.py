@@ -1,10 +1,65 @@
 import backoff
+import hashlib
+import json
+import multiprocessing
+import queue
+import re
 import requests
+import threading
 import time
-from bs4 import BeautifulSoup
-from config import FETCH_DELAY, MAX_EXCEPTIONS, BASE_URL, THEATRE_SHOWTIMES_URL
-from database import Showtime, Film
-from datetime import datetime, timedelta
+from bs4 import BeautifulSoup, SoupStrainer
+from circuit_breaker import TheatreCircuitBreakers, TheatreRetryBudgets
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from config import FETCH_RATE, FETCH_BURST, FETCH_CONCURRENCY, PARSE_WORKERS, PIPELINE_QUEUE_SIZE, HTTP_POOL_SIZE, HTML_PARSER, BASE_URL, THEATRE_SHOWTIMES_PATH
+from config import FETCH_RETRY_TRIES, FETCH_RETRY_FACTOR, FETCH_RETRY_BUDGET_MIN, FETCH_RETRY_BUDGET_RATIO, FETCH_MAX_RETRY_AFTER, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS
+from database import database, Showtime, Film, PageFingerprint
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from http_cache import HttpCache
+from peewee import chunked, EXCLUDED
+from metrics import RunMetrics
+from rate_limit import HostRateLimiter
+from replay import PageRecorder
+from scheduler import record_scan
+from showtime_index import ShowtimeIndex
+
+
+# Shared by all fetches so that concurrent requests stay inside the per host request budget
+rate_limiter = HostRateLimiter(FETCH_RATE, FETCH_BURST)
+
+# Retry budgets for the run of every theatre, shared by all fetches of the theatre and reset by fetch_targets
+retry_budgets = TheatreRetryBudgets(FETCH_RETRY_BUDGET_RATIO, FETCH_RETRY_BUDGET_MIN)
+
+# Cache of page validators and extracted showtimes, initialized with a directory to enable it
+http_cache = HttpCache(None)
+
+# Saves every page fetched so it can be replayed later, initialized with a directory to enable it
+recorder = PageRecorder(None)
+
+# Where showtimes pages are requested from. Links in the extracted showtimes always point to BASE_URL.
+showtimes_base_url = BASE_URL
+
+
+def set_showtimes_base_url(url):
+    global showtimes_base_url
+    showtimes_base_url = (url or BASE_URL).rstrip('/')
+
+
+# Session shared by all fetches so connections to AMC are kept alive and reused. requests already
+# negotiates gzip/deflate, and brotli as well when the brotli package is installed.
+def create_session():
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+session = create_session()
+
+# A single page to fetch, theatre is in the "location/theatre_key" format
+FetchTarget = namedtuple('FetchTarget', ['theatre', 'offering', 'datestr'])
 
 
 class ShowtimeResult(object):
@@ -14,6 +69,13 @@ class ShowtimeResult(object):
         self.theatre = theatre
         self.link = link
 
+    def to_dict(self):
+        return {'datetime': self.datetime.isoformat(), 'theatre': self.theatre, 'link': self.link}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(datetime.fromisoformat(d['datetime']), d['theatre'], d['link'])
+
 
 class FilmResult(object):
 
@@ -22,6 +84,13 @@ class FilmResult(object):
         self.title = title
         self.showtimes = showtimes
 
+    def to_dict(self):
+        return {'key': self.key, 'title': self.title, 'showtimes': [x.to_dict() for x in self.showtimes]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['key'], d['title'], [ShowtimeResult.from_dict(x) for x in d['showtimes']])
+
     def __repr__(self):
         formatted_showtimes = ', '.join([str(x.datetime) for x in self.showtimes])
         return f"FilmResult({self.key} [{self.title}], showtimes=[{formatted_showtimes}])"
@@ -33,29 +102,68 @@ class NewShowtimesResult(object):
         self.films = []
         self.showtimes = []
         self.exceptions = []
+        # New showtimes keyed by the FetchTarget of the page they were found on
+        self.showtimes_by_target = {}
+        # Number of pages skipped because they were unchanged since they were last processed, and the number processed
+        self.unchanged_pages = 0
+        self.changed_pages = 0
+        # FetchTargets that weren't requested because their theatre's circuit breaker was open or AMC asked to
+        # retry later than FETCH_MAX_RETRY_AFTER, left for the next run
+        self.deferred = []
+        # Theatres whose circuit breaker opened during the run
+        self.tripped_theatres = []
+        # PipelineStats of the fetch_targets run that produced this result
+        self.stats = None
+        # RunMetrics of the fetch_targets run that produced this result
+        self.metrics = None
 
     def append(self, other_result):
         self.films += other_result.films
         self.showtimes += other_result.showtimes
         self.exceptions += other_result.exceptions
+        for (target, showtimes) in other_result.showtimes_by_target.items():
+            self.showtimes_by_target.setdefault(target, []).extend(showtimes)
+        self.unchanged_pages += other_result.unchanged_pages
+        self.changed_pages += other_result.changed_pages
+        self.deferred += other_result.deferred
+        self.tripped_theatres += [t for t in other_result.tripped_theatres if t not in self.tripped_theatres]
 
 
-# Fetch the Films with showtimes that have available tickets given a date and theatre
-@backoff.on_exception(backoff.expo,
-                      requests.exceptions.RequestException,
-                      max_tries=3,
-                      factor=5.0)
-def fetch_showtimes(location, theatre_key, datestr, offering):
-    url = THEATRE_SHOWTIMES_URL.format(
-        location=location,
-        theatre_key=theatre_key,
-        datestr=datestr,
-        offering=offering
-    )
+# The outcome of fetching a single FetchTarget. When the page is unchanged from its fingerprint, films may
+# be None if parsing was skipped as well.
+class PageResult(object):
+
+    def __init__(self, target, films, body_hash, result_hash, unchanged):
+        self.target = target
+        self.films = films
+        self.body_hash = body_hash
+        self.result_hash = result_hash
+        self.unchanged = unchanged
 
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, 'html5lib')
-    films_soup = soup.find_all(class_="ShowtimesByTheatre-film")
+
+def hash_body(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+# Hash of the showtimes extracted from a page, independent of the order they appear in
+def hash_film_results(film_results):
+    rows = sorted((f.key, f.title, s.theatre, s.datetime.isoformat(), s.link) for f in film_results for s in f.showtimes)
+    return hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()
+
+
+# Parser backends, each builds a soup that contains at least every ShowtimesByTheatre-film element from a page.
+#   html5lib: builds the full document tree exactly like a browser would, slow but the most lenient.
+#   strainer: uses lxml and only builds the film elements (and their children), skipping the rest of the page.
+#     The strainer sees the raw class attribute, so it matches the class as one of possibly several classes.
+PARSERS = {
+    'html5lib': lambda content: BeautifulSoup(content, 'html5lib'),
+    'strainer': lambda content: BeautifulSoup(content, 'lxml', parse_only=SoupStrainer(class_=re.compile(r'(^|\s)ShowtimesByTheatre-film(\s|$)'))),
+}
+
+
+# Extracts the Films with available showtimes from the content of a theatre showtimes page
+def parse_showtimes(content, theatre_key, datestr, offering, parser=HTML_PARSER):
+    films_soup = PARSERS[parser](content).find_all(class_="ShowtimesByTheatre-film")
     films = []
     for film_soup in films_soup:
         film_title_wrapper_soup = film_soup.find(class_='MovieTitleHeader-title')
@@ -86,71 +194,514 @@ def fetch_showtimes(location, theatre_key, datestr, offering):
     return films
 
 
-def process_film_result(film_result):
-    new = NewShowtimesResult()
+def showtimes_url(target):
+    (location, theatre_key) = target.theatre.split('/')
+    return showtimes_base_url + THEATRE_SHOWTIMES_PATH.format(
+        location=location,
+        theatre_key=theatre_key,
+        datestr=target.datestr,
+        offering=target.offering
+    )
+
+
+# Details of the last request made on the current thread, used for the run metrics, and the retry budget of
+# the theatre it's for
+last_request = threading.local()
+
+
+def reset_last_request():
+    last_request.status = None
+    last_request.latency = None
+    last_request.bytes = 0
+    last_request.retries = 0
+
+
+def _count_retry(details):
+    last_request.retries = getattr(last_request, 'retries', 0) + 1
+    last_request.retry_budget.record_retry()
+
+
+# AMC asked for fewer requests, with a 429 response or a 503 with a Retry-After header. retry_after is the
+# number of seconds it asked to wait, if it said.
+class ThrottledError(requests.exceptions.HTTPError):
+
+    def __init__(self, response, retry_after):
+        super().__init__(f'{response.status_code} Throttled for url: {response.url}, retry after {retry_after}s', response=response)
+        self.retry_after = retry_after
+
+
+# Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
 
-    film = Film.get_or_none(key = film_result.key)
-    if film is None:
-        film = Film.create(key = film_result.key,
-                           title = film_result.title)
-        new.films.append(film)
-
-    for showtime_result in film_result.showtimes:
-        s = Showtime.get_or_none(film = film,
-                                 theatre = showtime_result.theatre,
-                                 date = showtime_result.datetime)
-        if s is None:
-            s = Showtime.create(film = film,
-                                theatre = showtime_result.theatre,
-                                date = showtime_result.datetime,
-                                link = showtime_result.link)
-            new.showtimes.append(s)
+# Exponential backoff between retries, except after being throttled with a Retry-After, when the rate
+# limiter already holds back every request to the host for as long as asked
+def _retry_wait(factor):
+    n = 0
+    error = yield
+    while True:
+        if isinstance(error, ThrottledError) and error.retry_after is not None:
+            error = yield 0
         else:
-            s.link = showtime_result.link
-            s.save()
+            error = yield factor * 2 ** n
+            n += 1
+
+
+def _give_up(error):
+    if isinstance(error, ThrottledError) and error.retry_after is not None and error.retry_after > FETCH_MAX_RETRY_AFTER:
+        return True
+    return not last_request.retry_budget.available()
+
+
+# Requests a page, conditional on it having changed from the cached entry if there is one. Server errors and
+# throttling raise an HTTPError, and are retried as long as last_request.retry_budget allows.
+@backoff.on_exception(_retry_wait,
+                      requests.exceptions.RequestException,
+                      max_tries=FETCH_RETRY_TRIES,
+                      giveup=_give_up,
+                      factor=FETCH_RETRY_FACTOR,
+                      on_backoff=_count_retry)
+def request_page(url, cached):
+    rate_limiter.acquire(url)
+    last_request.retry_budget.record_request()
+
+    start = time.perf_counter()
+    r = session.get(url, headers=HttpCache.conditional_headers(cached))
+    last_request.latency = time.perf_counter() - start
+    last_request.status = r.status_code
+    # Content-Length is the size sent over the wire, before any gzip/brotli decoding
+    content_length = r.headers.get('Content-Length')
+    last_request.bytes = int(content_length) if content_length is not None and content_length.isdigit() else len(r.content)
+
+    retry_after = parse_retry_after(r.headers.get('Retry-After'))
+    if r.status_code == 429 or (r.status_code == 503 and retry_after is not None):
+        if retry_after is not None and retry_after <= FETCH_MAX_RETRY_AFTER:
+            rate_limiter.pause(url, retry_after)
+        raise ThrottledError(r, retry_after)
+    if r.status_code >= 500:
+        raise requests.exceptions.HTTPError(f'{r.status_code} Server Error for url: {url}', response=r)
+    return r
+
+
+# A page that was downloaded and still needs to be parsed
+class RawPage(object):
+
+    def __init__(self, target, fingerprint, url, response, body_hash):
+        self.target = target
+        self.fingerprint = fingerprint
+        self.url = url
+        self.response = response
+        self.body_hash = body_hash
+
+
+# Requests the page for the target. When the fingerprint from the last time the page was processed is given
+# and the body matches it, parsing is skipped and an unchanged PageResult is returned. A PageResult is also
+# returned for a 304 response, using the showtimes from the cache. Otherwise a RawPage is returned for
+# parse_raw_page.
+def request_target(target, fingerprint=None):
+    url = showtimes_url(target)
+    cached = http_cache.get(url)
+
+    last_request.retry_budget = retry_budgets.get(target.theatre)
+    r = request_page(url, cached)
+    recorder.put(url, r)
+    if r.status_code == 304 and cached is not None:
+        films = [FilmResult.from_dict(x) for x in cached['data']]
+        body_hash = fingerprint.body_hash if fingerprint is not None else None
+        return page_result(target, fingerprint, films, body_hash)
+
+    body_hash = hash_body(r.content)
+    # Without a cache entry the page is still parsed, so the cache gets one and later requests can get a 304
+    if fingerprint is not None and fingerprint.body_hash == body_hash and (cached is not None or not http_cache.enabled):
+        return PageResult(target, None, body_hash, fingerprint.result_hash, True)
+
+    return RawPage(target, fingerprint, url, r, body_hash)
+
+
+# Parses a RawPage into a PageResult. parse is called with the same arguments as parse_showtimes, which lets
+# the parsing be done elsewhere (e.g. in another process).
+def parse_raw_page(raw, parser=HTML_PARSER, parse=parse_showtimes):
+    target = raw.target
+    films = parse(raw.response.content, target.theatre.split('/')[-1], target.datestr, target.offering, parser)
+    if raw.response.ok:
+        http_cache.put(raw.url, raw.response, [x.to_dict() for x in films])
+
+    return page_result(target, raw.fingerprint, films, raw.body_hash)
+
+
+def page_result(target, fingerprint, films, body_hash):
+    result_hash = hash_film_results(films)
+    unchanged = fingerprint is not None and fingerprint.result_hash == result_hash
+    return PageResult(target, films, body_hash, result_hash, unchanged)
+
+
+# Fetches and parses the page for the target, see request_target
+def fetch_page(target, fingerprint=None, parser=HTML_PARSER):
+    page = request_target(target, fingerprint)
+    if isinstance(page, RawPage):
+        page = parse_raw_page(page, parser)
+    return page
+
+
+# Fetch the Films with showtimes that have available tickets given a date and theatre
+def fetch_showtimes(location, theatre_key, datestr, offering, parser=HTML_PARSER):
+    target = FetchTarget(f'{location}/{theatre_key}', offering, datestr)
+    return fetch_page(target, parser=parser).films
+
+
+# Loads the fingerprints of the targets' pages with a single query, keyed by target
+def load_page_fingerprints(targets):
+    if len(targets) == 0:
+        return {}
+
+    dates = [t.datestr for t in targets]
+    q = PageFingerprint.select().where(PageFingerprint.date.between(min(dates), max(dates)))
+    return {FetchTarget(f.theatre, f.offering, f.date): f for f in q}
+
+
+def save_page_fingerprint(page):
+    (PageFingerprint
+     .insert(theatre=page.target.theatre,
+             offering=page.target.offering,
+             date=page.target.datestr,
+             body_hash=page.body_hash,
+             result_hash=page.result_hash)
+     .on_conflict(conflict_target=[PageFingerprint.theatre, PageFingerprint.offering, PageFingerprint.date],
+                  update={PageFingerprint.body_hash: page.body_hash,
+                          PageFingerprint.result_hash: page.result_hash})
+     .execute())
+
+
+# Adds the films and showtimes of a fetched page to the database along with its fingerprint, unless the page
+# is unchanged since it was last processed. Either way the fetch is recorded for the scan schedule.
+def process_page(page, index):
+    with database.atomic():
+        if page.unchanged:
+            new = NewShowtimesResult()
+            new.unchanged_pages = 1
+        else:
+            new = process_film_results(page.films, index)
+            save_page_fingerprint(page)
+            new.changed_pages = 1
+            if len(new.showtimes) > 0:
+                new.showtimes_by_target[page.target] = list(new.showtimes)
+
+        record_scan(page.target, not page.unchanged)
 
     return new
 
 
-def fetch_new_showtimes(lookforward_days, theatres, offerings, post_request_callback):
-    result = NewShowtimesResult()
-    exceptions = []
-    first_fetch = True
-    start_date = datetime.now()
+# Adds the films and showtimes of a page of results to the database in a single transaction. The results are
+# diffed against the in-memory index of known showtimes, so only new showtimes are inserted (in bulk) and only
+# showtimes whose link changed are updated. The index is updated to match.
+def process_film_results(film_results, index):
+    new = NewShowtimesResult()
+    film_results = [x for x in film_results if len(x.showtimes) > 0]
+    if len(film_results) == 0:
+        return new
+
+    films = {}
+    for film_result in film_results:
+        if film_result.key not in films:
+            film = Film(key = film_result.key, title = film_result.title)
+            films[film.key] = film
+            if not index.has_film(film.key):
+                new.films.append(film)
+
+    showtime_results = {}
+    for film_result in film_results:
+        for showtime_result in film_result.showtimes:
+            showtime_results[(film_result.key, showtime_result.theatre, showtime_result.datetime)] = showtime_result
+
+    changed = []
+    for ((film_key, theatre, date), showtime_result) in showtime_results.items():
+        d = index.diff(film_key, theatre, date, showtime_result.link)
+        if d == ShowtimeIndex.NEW:
+            new.showtimes.append(Showtime(film = films[film_key],
+                                          theatre = theatre,
+                                          date = date,
+                                          link = showtime_result.link))
+        elif d == ShowtimeIndex.CHANGED:
+            changed.append((film_key, theatre, date, showtime_result.link))
+
+    # Inserted as upserts, so rows another connection wrote since the index was loaded don't fail the run
+    with database.atomic():
+        if len(new.films) > 0:
+            Film.insert_many([(f.key, f.title) for f in new.films], fields=[Film.key, Film.title]).on_conflict_ignore().execute()
+        for batch in chunked(new.showtimes, 100):
+            (Showtime
+             .insert_many([(s.film.key, s.theatre, s.date, s.link) for s in batch],
+                          fields=[Showtime.film, Showtime.theatre, Showtime.date, Showtime.link])
+             .on_conflict(conflict_target=[Showtime.film, Showtime.theatre, Showtime.date], update={Showtime.link: EXCLUDED.link})
+             .execute())
+        for (film_key, theatre, date, link) in changed:
+            (Showtime
+             .update(link = link)
+             .where(Showtime.film == film_key, Showtime.theatre == theatre, Showtime.date == date)
+             .execute())
+
+    for s in new.showtimes:
+        index.add(s.film.key, s.theatre, s.date, s.link)
+    for (film_key, theatre, date, link) in changed:
+        index.add(film_key, theatre, date, link)
 
-    for i in range(0, lookforward_days):
-        if len(result.exceptions) >= MAX_EXCEPTIONS:
-            break
+    return new
 
-        date = start_date + timedelta(days=i)
-        datestr = date.strftime('%Y-%m-%d')
 
-        for theatre in theatres:
-            if len(result.exceptions) >= MAX_EXCEPTIONS:
-                break
+def build_fetch_targets(lookforward_days, theatres, offerings, start_date=None):
+    if start_date is None:
+        start_date = datetime.now()
 
+    targets = []
+    for i in range(0, lookforward_days):
+        datestr = (start_date + timedelta(days=i)).strftime('%Y-%m-%d')
+        for theatre in theatres:
             for offering in offerings:
-                if not first_fetch:
-                    # Space out requests a bit to avoid potentially getting throttled
-                    time.sleep(FETCH_DELAY)
+                targets.append(FetchTarget(theatre, offering, datestr))
+
+    return targets
+
+
+def fetch_new_showtimes(lookforward_days, theatres, offerings, post_request_callback, concurrency=FETCH_CONCURRENCY):
+    targets = build_fetch_targets(lookforward_days, theatres, offerings)
+    return fetch_targets(targets, post_request_callback, concurrency)
+
+
+# A target whose page couldn't be fetched or parsed
+class FailedPage(object):
 
+    def __init__(self, target, error):
+        self.target = target
+        self.error = error
+
+
+# A target that wasn't requested because its theatre's circuit breaker was open
+class DeferredPage(object):
+
+    def __init__(self, target):
+        self.target = target
+
+
+# Throughput and queue depth of one stage of the fetch_targets pipeline
+class StageStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.pages = 0
+        # Seconds spent working, summed over all of the stage's workers
+        self.busy = 0.0
+        # Deepest the queue feeding this stage got
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.pages += 1
+            self.busy += seconds
+
+    def observe_queue(self, depth):
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def __str__(self):
+        rate = self.pages / self.busy if self.busy > 0 else 0
+        return f"{self.name}: {self.pages} pages in {self.busy:.1f}s of work ({rate:.1f} pages/s per worker), max queue depth {self.max_queue_depth}"
+
+
+class PipelineStats(object):
+
+    def __init__(self):
+        self.fetch = StageStats('fetch')
+        self.parse = StageStats('parse')
+        self.write = StageStats('write')
+        self.elapsed = 0.0
+
+    @property
+    def stages(self):
+        return [self.fetch, self.parse, self.write]
+
+
+# Fetches the targets through a pipeline of three stages connected by bounded queues:
+#   fetch: `concurrency` threads request pages, spaced out by the shared rate_limiter to avoid getting throttled.
+#   parse: pages are parsed on a pool of `parse_workers` processes so parsing can use more than one core, or
+#          on a single thread when parse_workers is 0.
+#   write: the calling thread processes the parsed pages, so all database access stays on the same connection.
+# When a queue is full the stages before it wait, so no more than `queue_size` pages are waiting at each
+# stage. Failed requests open the circuit breaker of their theatre, and the theatre's pages are deferred to the
+# next run while it is open, so a failing theatre doesn't hold back the others. Fetching stops when AMC asks to
+# retry later than FETCH_MAX_RETRY_AFTER, deferring the remaining pages, or once should_stop returns True if
+# it's given. Either way pages already fetched are still processed.
+# Per page measurements are recorded in `metrics` (a new RunMetrics if not given), attached to the result.
+def fetch_targets(targets, post_request_callback, concurrency=FETCH_CONCURRENCY, should_stop=None,
+                  parse_workers=PARSE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, metrics=None):
+    # Without a fetch thread nothing would ever tell the later stages to finish
+    if concurrency < 1:
+        raise ValueError(f'concurrency must be at least 1, got {concurrency}')
+    if parse_workers < 0:
+        raise ValueError(f'parse_workers must be at least 0, got {parse_workers}')
+
+    result = NewShowtimesResult()
+    stats = PipelineStats()
+    result.stats = stats
+    result.metrics = metrics if metrics is not None else RunMetrics()
+    started = time.perf_counter()
+
+    fingerprints = load_page_fingerprints(targets)
+    index = ShowtimeIndex().load()
+
+    retry_budgets.reset()
+    breakers = TheatreCircuitBreakers(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+    throttled = threading.Event()
+
+    pending = queue.Queue()
+    for target in targets:
+        pending.put(target)
+    parse_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    pool = None
+    parse = parse_showtimes
+    if parse_workers > 0:
+        # Spawn rather than fork since this process has other threads running
+        pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn'))
+        parse = lambda *args: pool.submit(parse_showtimes, *args).result()
+    parse_threads = max(1, parse_workers)
+
+    # The last worker of a stage to finish tells the workers of the next stage there is nothing left
+    remaining = {'fetch': concurrency, 'parse': parse_threads}
+    remaining_lock = threading.Lock()
+
+    def finish_stage(name, next_queue, next_workers):
+        with remaining_lock:
+            remaining[name] -= 1
+            last = remaining[name] == 0
+        if last:
+            for _ in range(next_workers):
+                next_queue.put(None)
+
+    def put(q, page, stage_stats):
+        q.put(page)
+        stage_stats.observe_queue(q.qsize())
+
+    def stopping():
+        return stop.is_set() or throttled.is_set() or (should_stop is not None and should_stop())
+
+    def fetch_worker():
+        try:
+            while not stopping():
+                try:
+                    target = pending.get_nowait()
+                except queue.Empty:
+                    break
+
+                breaker = breakers.get(target.theatre)
+                if not breaker.allow():
+                    put(write_queue, DeferredPage(target), stats.write)
+                    continue
+
+                start = time.perf_counter()
+                reset_last_request()
                 try:
-                    (theatre_location, theatre_key) = theatre.split('/')
-                    film_results = fetch_showtimes(theatre_location, theatre_key, datestr, offering)
+                    page = request_target(target, fingerprints.get(target))
                 except Exception as err:
-                    result.exceptions.append((err, f"Encountered exception after retries requesting for {theatre}, {datestr}, {offering}"))
-                    post_request_callback(err)
-                    if len(result.exceptions) >= MAX_EXCEPTIONS:
-                        break
-                    else:
-                        continue
+                    page = FailedPage(target, err)
+                stats.fetch.record(time.perf_counter() - start)
+
+                if not isinstance(page, FailedPage):
+                    breaker.record_success()
+                elif isinstance(page.error, ThrottledError):
+                    # Throttling applies to every theatre, so it isn't held against this one
+                    breaker.record_ignored()
+                    if page.error.retry_after is not None and page.error.retry_after > FETCH_MAX_RETRY_AFTER:
+                        throttled.set()
+                else:
+                    breaker.record_failure()
+                result.metrics.record_request(target,
+                                              status=last_request.status,
+                                              latency=last_request.latency,
+                                              bytes=last_request.bytes,
+                                              retries=last_request.retries,
+                                              error=repr(page.error) if isinstance(page, FailedPage) else None)
+
+                if isinstance(page, RawPage):
+                    put(parse_queue, page, stats.parse)
+                else:
+                    put(write_queue, page, stats.write)
+        finally:
+            finish_stage('fetch', parse_queue, parse_threads)
+
+    def parse_worker():
+        try:
+            while True:
+                raw = parse_queue.get()
+                if raw is None:
+                    break
+
+                start = time.perf_counter()
+                try:
+                    page = parse_raw_page(raw, parse=parse)
+                except Exception as err:
+                    page = FailedPage(raw.target, err)
+                    result.metrics.record_error(raw.target, repr(err))
+                stats.parse.record(time.perf_counter() - start)
+                result.metrics.record_parse(raw.target, time.perf_counter() - start)
+
+                put(write_queue, page, stats.write)
+        finally:
+            finish_stage('parse', write_queue, 1)
+
+    threads = [threading.Thread(target=fetch_worker, daemon=True) for _ in range(concurrency)]
+    threads += [threading.Thread(target=parse_worker, daemon=True) for _ in range(parse_threads)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            page = write_queue.get()
+            if page is None:
+                break
 
-                post_request_callback(None)
+            if isinstance(page, DeferredPage):
+                result.deferred.append(page.target)
+                continue
 
-                for film_result in (x for x in film_results if len(x.showtimes) > 0):
-                    n = process_film_result(film_result)
-                    result.append(n)
+            if isinstance(page, FailedPage):
+                result.exceptions.append((page.error, f"Encountered exception after retries requesting for {page.target.theatre}, {page.target.datestr}, {page.target.offering}"))
+                post_request_callback(page.error)
+                continue
 
-                first_fetch = False
+            post_request_callback(None)
+
+            start = time.perf_counter()
+            result.append(process_page(page, index))
+            stats.write.record(time.perf_counter() - start)
+            result.metrics.record_write(page.target, time.perf_counter() - start)
+    except BaseException:
+        # Let the other stages wind down, they would otherwise wait on a full queue forever
+        stop.set()
+        while write_queue.get() is not None:
+            pass
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        if pool is not None:
+            pool.shutdown()
+        stats.elapsed = time.perf_counter() - started
+
+    if throttled.is_set():
+        while not pending.empty():
+            result.deferred.append(pending.get_nowait())
+    result.tripped_theatres = breakers.tripped()
 
     return result
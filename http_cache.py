@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+# On-disk cache of fetched pages keyed by URL. Only the response validators (ETag/Last-Modified) and the
+# data extracted from the page are stored, so a 304 Not Modified response can skip both downloading and
+# parsing the page again. Like the database, the cache is created up front and initialized with a
+# directory later, a cache without a directory is disabled.
+class HttpCache(object):
+
+    # Bump when the format of the stored data changes so that old entries are ignored
+    VERSION = 1
+
+    def __init__(self, directory=None):
+        self.init(directory)
+
+    def init(self, directory):
+        self.directory = directory or None
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        if not self.enabled:
+            return None
+
+        try:
+            with open(self._path(url), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('version') != self.VERSION or entry.get('url') != url:
+            return None
+        return entry
+
+    # Headers to make the request conditional on the cached entry having changed
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, response, data):
+        if not self.enabled:
+            return
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            # Nothing to revalidate with, so there is no point storing the page
+            return
+
+        entry = {
+            'version': self.VERSION,
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': data,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(url))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,92 +1,269 @@
 import argparse
+import csv
+import json
+import signal
 import sys
+import threading
+import time
 import traceback
-from config import MAX_EXCEPTIONS
-from database import database, Showtime, Film, purge_old_records
+from config import FETCH_RATE, FETCH_BURST, FETCH_CONCURRENCY, HTML_PARSER, HTML_PARSERS, PARSE_WORKERS, SERVE_INTERVAL_MINUTES, NOTIFICATION_BACKEND
 from datetime import datetime, timedelta
-from fetch_showtimes import fetch_new_showtimes, fetch_showtimes
-from outputs import send_email, gen_formated_showtimes, gen_new_showtimes_html, gen_formated_film_results
 
+# Modules are imported by the commands that use them rather than up here, so that light commands like email and
+# debug start quickly without importing requests, BeautifulSoup and Jinja. See `bench startup`.
 
-def notify(args):
-    with database:
-        database.create_tables([Film, Showtime])
 
-        def post_request_callback(err):
-            if err is not None:
-                print('x', end='')
-            else:
-                print('.', end='')
-            sys.stdout.flush()
+# The database at --db-file
+def open_database(args):
+    from database import database
+
+    database.init(args.db_file)
+    return database
+
 
-        print(f"[{str(datetime.now())}] Starting requests for {args.lookforward_days} days, {len(args.theatres)} theatres, and {len(args.offerings)} offerings ({args.lookforward_days * len(args.theatres) * len(args.offerings)} requests)")
-        new = fetch_new_showtimes(args.lookforward_days, args.theatres, args.offerings, post_request_callback)
-        print()
+# Configures fetching with the --http-cache-dir, --record-dir and --amc-url options
+def init_fetching(args):
+    from fetch_showtimes import http_cache, recorder, set_showtimes_base_url
 
-        if len(new.showtimes):
-            print("New showtimes:")
-            print(gen_formated_showtimes(new.showtimes, args.theatres))
-            send_email(
+    http_cache.init(args.http_cache_dir)
+    recorder.init(args.record_dir)
+    set_showtimes_base_url(args.amc_url)
+
+
+def notify(args):
+    from database import migrate
+
+    init_fetching(args)
+    # Not `with database`, which would hold a transaction open for the whole run. Each page is committed on its
+    # own instead, so other connections see the results as they're written and a killed run keeps them.
+    with open_database(args).connection_context():
+        migrate()
+        run_notify(args)
+
+
+# The profiles to notify: those in the --profiles file, plus one for --email-to/--theatres/--offerings if given
+def notify_profiles(args):
+    from profiles import Profile, load_profiles
+
+    profiles = load_profiles(args.profiles) if args.profiles else []
+    if args.email_to:
+        profiles.append(Profile('default', args.email_to, args.theatres, args.offerings))
+    return profiles
+
+
+# A single notify run: fetches the pages, emails any new showtimes and purges old records. Expects the
+# database to be connected and migrated already. should_stop is checked between requests to end the run
+# early, the pages already fetched are still processed.
+def run_notify(args, should_stop=None):
+    from database import purge_old_records
+    from fetch_showtimes import build_fetch_targets, fetch_targets, rate_limiter
+    from metrics import write_file_atomic
+    from notifications import Notification, PrintBackend, create_backend
+    from outbox import dispatcher
+    from outputs import gen_formated_showtimes, gen_new_showtimes_html
+    from scheduler import due_targets
+
+    def post_request_callback(err):
+        if err is not None:
+            print('x', end='')
+        else:
+            print('.', end='')
+        sys.stdout.flush()
+
+    # Waits for the notifications queued so far to be delivered, failed ones stay in the outbox for the next run
+    def flush_notifications():
+        failed = dispatcher.flush()
+        for (notification, error) in failed:
+            print(f"Failed to send \"{notification.subject}\" to {', '.join(notification.recipients)}: {error!r}")
+
+    rate_limiter.configure(args.requests_per_second, FETCH_BURST)
+
+    # Notifications are sent in the background while the run continues
+    dispatcher.init(PrintBackend() if args.dry_run else create_backend(args.notification_backend, args.email_sender, args.email_password))
+    # A dry run would print the notifications left by earlier runs and drop them as delivered, leave them for
+    # the next real run instead
+    if not args.dry_run:
+        retried = dispatcher.retry_pending()
+        if retried:
+            print(f"Retrying {retried} notifications left in the outbox by earlier runs")
+
+    profiles = notify_profiles(args)
+    theatres = list(dict.fromkeys(t for p in profiles for t in p.theatres))
+    offerings = list(dict.fromkeys(o for p in profiles for o in p.offerings))
+
+    # Every page any profile needs, each fetched only once, nearest dates first
+    targets = list(dict.fromkeys(t for p in profiles for t in build_fetch_targets(args.lookforward_days, p.theatres, p.offerings)))
+    targets.sort(key=lambda t: t.datestr)
+    if args.adaptive_schedule:
+        targets = due_targets(targets, max_requests=args.max_requests)
+    elif args.max_requests is not None:
+        targets = targets[:args.max_requests]
+
+    print(f"[{str(datetime.now())}] Starting requests for {args.lookforward_days} days, {len(theatres)} theatres, and {len(offerings)} offerings ({len(targets)} requests)")
+    new = fetch_targets(targets, post_request_callback, args.concurrency, should_stop, args.parse_workers)
+    print()
+
+    if len(new.showtimes):
+        print("New showtimes:")
+        print(gen_formated_showtimes(new.showtimes, theatres))
+
+    for profile in profiles:
+        showtimes = [s for (t, ss) in new.showtimes_by_target.items() if profile.matches(t) for s in ss]
+        if len(showtimes):
+            if len(profiles) > 1:
+                print(f"Sending {len(showtimes)} new showtimes to profile {profile.name}")
+            dispatcher.send(Notification(
                 f"New AMC showtimes found!",
-                gen_new_showtimes_html(new.showtimes, args.theatres),
-                args.email_sender,
-                args.email_to,
-                args.email_password,
+                gen_new_showtimes_html(showtimes, profile.theatres),
+                profile.email_to,
                 html=True
-            )
+            ))
+
+    if len(new.exceptions) == 0:
+        print('Success')
+    elif len(new.deferred) > 0:
+        print(f"Finished with {len(new.exceptions)} exceptions, deferring {len(new.deferred)} pages to the next run")
+    else:
+        print(f"Success with {len(new.exceptions)} exceptions")
+
+    print("\nSummary:\n")
+    print(f"  Found {len(new.showtimes)} new showtimes and {len(new.films)} new films")
+    print(f"  Processed {new.changed_pages} changed pages and skipped {new.unchanged_pages} unchanged pages")
+    if len(new.deferred) > 0:
+        print(f"  Deferred {len(new.deferred)} pages to the next run")
+    if len(new.tripped_theatres) > 0:
+        print(f"  Circuit breakers opened for {', '.join(new.tripped_theatres)}")
+    print(f"  Pipeline took {new.stats.elapsed:.1f}s")
+    for stage in new.stats.stages:
+        print(f"    {stage}")
+    purged = purge_old_records()
+    print(f"  Purged {purged.showtimes} old showtimes and {purged.films} films with no showtimes")
+
+    new.metrics.finish(new_showtimes=len(new.showtimes),
+                       new_films=len(new.films),
+                       changed_pages=new.changed_pages,
+                       unchanged_pages=new.unchanged_pages,
+                       deferred_pages=len(new.deferred),
+                       tripped_theatres=len(new.tripped_theatres),
+                       exceptions=len(new.exceptions),
+                       purged_showtimes=purged.showtimes,
+                       purged_films=purged.films)
+    report = new.metrics.report()
+    latency = report['latency_seconds']
+    if latency['count'] > 0:
+        print(f"  Request latency p50 {latency['p50']:.2f}s, p90 {latency['p90']:.2f}s, max {latency['max']:.2f}s with {report['requests']['retries']} retries and {report['requests']['bytes'] / 1024:.0f}KiB received")
+    print()
+
+    report_json = new.metrics.to_json()
+    if args.report_file:
+        write_file_atomic(args.report_file, report_json)
+    if args.prometheus_file:
+        write_file_atomic(args.prometheus_file, new.metrics.to_prometheus())
+    attachments = [('run-report.json', report_json)]
+
+    if len(new.exceptions) > 0:
+        s = f"Encountered {len(new.exceptions)} Exceptions:\n\n"
+        for e in new.exceptions:
+            s += e[1] + "\n"
+        print(s)
+
+        e = new.exceptions[-1][0]
+        e_str = ''.join(traceback.TracebackException.from_exception(e).format())
+
+        if args.log_email_recipients:
+            dispatcher.send(Notification(
+                "AMC Showtime Notifier Exception",
+                f"At {str(datetime.now())} AMC Showtime notifier encountered exceptions!\n\n{s}\n\nLatest exception:\n{e_str}",
+                args.log_email_recipients,
+                attachments=attachments
+            ))
+        flush_notifications()
+
+        # Every processed page is already committed, so the showtimes found at healthy theatres aren't notified again
+        print("Raising latest exception...")
+        raise e
+    else:
+        if args.log_email_recipients:
+            dispatcher.send(Notification(
+                "AMC Showtime Notifier Success",
+                f"Successfully completed at {str(datetime.now())}",
+                args.log_email_recipients,
+                attachments=attachments
+            ))
+        flush_notifications()
+
+
+# Stays resident and runs notify every interval, keeping the database connection, HTTP connection pool and
+# templates warm between runs. Stops cleanly after the current request on SIGTERM or SIGINT.
+def serve(args):
+    from database import migrate
+
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        print(f"\n[{str(datetime.now())}] Received {signal.Signals(signum).name}, stopping...")
+        sys.stdout.flush()
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    init_fetching(args)
+    # Like notify, every page is committed on its own rather than the whole time the server runs
+    with open_database(args).connection_context():
+        migrate()
+
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                run_notify(args, stop.is_set)
+            except Exception:
+                # The exception was already reported by run_notify, keep serving
+                traceback.print_exc()
+            sys.stdout.flush()
 
-        if new.exceptions == 0:
-            print('Success')
-        elif len(new.exceptions) == MAX_EXCEPTIONS:
-            print(f'Failed after encountering {MAX_EXCEPTIONS} exceptions')
-        else:
-            print(f"Success with {len(new.exceptions)} exceptions")
-
-        print("\nSummary:\n")
-        print(f"  Found {len(new.showtimes)} new showtimes and {len(new.films)} new films")
-        purged = purge_old_records()
-        print(f"  Purged {purged.showtimes} old showtimes and {purged.films} films with no showtimes\n")
-
-        if len(new.exceptions) > 0:
-            s = f"Encountered {len(new.exceptions)} Exceptions:\n\n"
-            for e in new.exceptions:
-                s += e[1] + "\n"
-            print(s)
-
-            e = new.exceptions[-1][0]
-            e_str = ''.join(traceback.TracebackException.from_exception(e).format())
-
-            if args.log_email_recipients:
-                send_email(
-                    "AMC Showtime Notifier Exception",
-                    f"At {str(datetime.now())} AMC Showtime notifier encountered exceptions!\n\n{s}\n\nLatest exception:\n{e_str}",
-                    args.email_sender,
-                    args.log_email_recipients,
-                    args.email_password
-                )
-
-            print("Raising latest exception...")
-            raise e
-        else:
-            if args.log_email_recipients:
-                send_email(
-                    "AMC Showtime Notifier Success",
-                    f"Successfully completed at {str(datetime.now())}",
-                    args.email_sender,
-                    args.log_email_recipients,
-                    args.email_password
-                )
+            if not stop.is_set():
+                next_run = datetime.now() + timedelta(seconds=max(0, args.interval_minutes * 60 - (time.monotonic() - started)))
+                print(f"[{str(datetime.now())}] Next run at {str(next_run)}")
+                sys.stdout.flush()
+                stop.wait((next_run - datetime.now()).total_seconds())
 
 
 def email(args):
-    send_email(args.subject, args.body, args.send_from, args.recipients, args.smtp_password)
+    from notifications import Notification, create_backend
+
+    backend = create_backend(args.notification_backend, args.send_from, args.smtp_password)
+    try:
+        backend.send(Notification(args.subject, args.body, args.recipients))
+    finally:
+        backend.close()
+
+
+# Showtimes matching the debug filters with their films joined, ordered by film, theatre and date
+def query_showtimes(args):
+    from database import Showtime, Film
+
+    q = Showtime.select(Showtime, Film).join(Film)
+    if args.from_date:
+        q = q.where(Showtime.date >= datetime.strptime(args.from_date, '%Y-%m-%d'))
+    if args.to_date:
+        q = q.where(Showtime.date < datetime.strptime(args.to_date, '%Y-%m-%d') + timedelta(days=1))
+    if args.theatre:
+        q = q.where(Showtime.theatre == args.theatre)
+    return q.order_by(Showtime.film, Showtime.theatre, Showtime.date)
 
 
 def debug(args):
-    with database:
+    from database import Showtime, Film, PageFingerprint, ScanState, Outbox, migrate, purge_old_records, clear_page_state
+    from peewee import fn, JOIN
+
+    with open_database(args) as database:
+        migrate()
 
         if args.drop_tables:
-            database.drop_tables([Film, Showtime])
+            database.drop_tables([Film, Showtime, PageFingerprint, ScanState, Outbox])
+            # Recreate the schema from scratch on the next run
+            database.pragma('user_version', 0)
 
         if args.delete_film is not None:
             q = Film.delete().where(Film.key == args.delete_film)
@@ -94,80 +271,203 @@ def debug(args):
 
             q = Showtime.delete().where(Showtime.film == args.delete_film)
             q.execute()
+            clear_page_state()
 
         if args.purge_old_records:
             results = purge_old_records()
-            print(f"Removed {results['showtimes']} showtimes and {results['films']} films")
+            print(f"Removed {results.showtimes} showtimes and {results.films} films")
 
         if args.clear_links:
-            for showtime in Showtime.select():
-                showtime.link = ""
-                showtime.save()
+            Showtime.update(link="").execute()
+            clear_page_state()
 
         if args.print_films:
-            for film in Film.select():
-                print(f'{film.title} [{film.key}] {film.showtimes.count()} showtimes')
+            q = (Film
+                 .select(Film, fn.COUNT(Showtime.id).alias('showtimes_count'))
+                 .join(Showtime, JOIN.LEFT_OUTER)
+                 .group_by(Film.key))
+            for film in q.iterator():
+                print(f'{film.title} [{film.key}] {film.showtimes_count} showtimes')
 
         if args.print_showtimes:
-            for showtime in Showtime.select():
-                print(f'{showtime.date} - {showtime.theatre} - {showtime.film} ({showtime.link})')
+            q = query_showtimes(args)
+            if args.format == 'csv':
+                writer = csv.writer(sys.stdout)
+                writer.writerow(['date', 'theatre', 'film', 'title', 'link'])
+                for showtime in q.iterator():
+                    writer.writerow([showtime.date, showtime.theatre, showtime.film.key, showtime.film.title, showtime.link])
+            elif args.format == 'jsonl':
+                for showtime in q.iterator():
+                    sys.stdout.write(json.dumps({
+                        'date': showtime.date.isoformat(),
+                        'theatre': showtime.theatre,
+                        'film': showtime.film.key,
+                        'title': showtime.film.title,
+                        'link': showtime.link,
+                    }) + '\n')
+            else:
+                for showtime in q.iterator():
+                    print(f'{showtime.date} - {showtime.theatre} - {showtime.film} ({showtime.link})')
 
         if args.pprint_showtimes:
-            theatres = set((x.theatre for x in Showtime.select(Showtime.theatre)))
-            print(gen_formated_showtimes(list(Showtime.select()), theatres))
+            from outputs import iter_grouped_showtimes, iter_formated_showtimes
+
+            for chunk in iter_formated_showtimes(iter_grouped_showtimes(query_showtimes(args).iterator())):
+                sys.stdout.write(chunk)
+            print()
 
         if args.print_showtimes_html:
-            theatres = set((x.theatre for x in Showtime.select(Showtime.theatre)))
+            from outputs import iter_grouped_showtimes, iter_showtimes_html
 
-            print(gen_new_showtimes_html(list(Showtime.select()), theatres))
+            for chunk in iter_showtimes_html(iter_grouped_showtimes(query_showtimes(args).iterator())):
+                sys.stdout.write(chunk)
+            print()
 
         if args.print_showtimes_before:
             d = datetime.strptime(args.print_showtimes_before, '%Y-%m-%d %I:%M%p')
-            for showtime in Showtime.select().where(Showtime.date < d):
+            for showtime in Showtime.select(Showtime, Film).join(Film).where(Showtime.date < d).iterator():
                 print(f'{showtime.date} - {showtime.film}')
 
         if args.delete_showtimes_before:
             d = datetime.strptime(args.delete_showtimes_before, '%Y-%m-%d %I:%M%p')
             q = Showtime.delete().where(Showtime.date < d)
             count_removed = q.execute()
+            clear_page_state()
             print(f'{count_removed} records removed')
 
         if args.purge_theatre:
             q = Showtime.delete().where(Showtime.theatre == args.purge_theatre)
             count_removed = q.execute()
+            clear_page_state()
             print(f'{count_removed} records removed')
 
 
 def fetch(args):
+    from fetch_showtimes import fetch_showtimes
+    from outputs import gen_formated_film_results
+
+    init_fetching(args)
     (theatre_location, theatre_key) = args.theatre.split('/')
-    films = fetch_showtimes(theatre_location, theatre_key, args.datestr, args.offering)
+    films = fetch_showtimes(theatre_location, theatre_key, args.datestr, args.offering, args.parser)
     print(gen_formated_film_results(films))
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Alert when new showtimes are available.')
-
-    parser.add_argument('--db-file', default='amc_showtimes.db',
-                        help='Customize the location of the SQLLite database file to use. By default its \'amc_showtimes.db\'')
-
-    subparsers = parser.add_subparsers(required=True)
-
-    notify_parser = subparsers.add_parser('notify', help='Check for and notify if there are new showtimes')
-    notify_parser.set_defaults(func=notify)
+def bench(args):
+    import benchmarks
+
+    if args.benchmark == 'db':
+        print(benchmarks.benchmark_database(args.showtimes))
+    elif args.benchmark == 'index':
+        print(benchmarks.benchmark_showtime_index(args.showtimes))
+    elif args.benchmark == 'outputs':
+        print(benchmarks.benchmark_outputs(args.showtimes))
+    elif args.benchmark == 'replay':
+        # Full notify runs against the replay server, with emails printed instead of sent
+        def notify_args(theatres, offerings):
+            notify_parser = argparse.ArgumentParser()
+            add_notify_arguments(notify_parser)
+            return notify_parser.parse_args([
+                str(args.days), 'bench@localhost', '',
+                '--email-to', 'bench@localhost',
+                '--theatres', *theatres,
+                '--offerings', *offerings,
+                '--concurrency', str(args.concurrency),
+                '--parse-workers', str(args.parse_workers),
+                '--requests-per-second', '1000000',
+                '--dry-run',
+            ])
+
+        print(benchmarks.benchmark_replay(run_notify, notify_args, args.pages, args.cycles, args.latency, args.error_rate,
+                                          args.theatres, args.offerings, args.retry_after, args.failing_theatres))
+    elif args.benchmark == 'startup':
+        (report, passed) = benchmarks.benchmark_startup()
+        print(report)
+        if not passed:
+            sys.exit(1)
+
+
+def compile_templates(args):
+    from outputs import precompile_templates
+
+    for name in precompile_templates():
+        print(f'Compiled {name}')
+
+
+# argparse types for counts that must be at least 1 or at least 0
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {n}')
+    return n
+
+
+def non_negative_int(value):
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError(f'must be at least 0, got {n}')
+    return n
+
+
+def add_notify_arguments(notify_parser):
     notify_parser.add_argument('lookforward_days', type=int,
                                 help='How many days in the future to process showtimes')
     notify_parser.add_argument('email_sender',
                                help='Gmail email account to send notifications from')
     notify_parser.add_argument('email_password',
                                help='App password for the Gmail email account to send notifications from')
-    notify_parser.add_argument('--email-to', nargs='+', required=True,
-                               help='Recipients for the new showtimes notification email.')
-    notify_parser.add_argument('--theatres', nargs='+', required=True,
+    notify_parser.add_argument('--email-to', nargs='+',
+                               help='Recipients for the new showtimes notification email. Required along with --theatres and --offerings unless --profiles is given.')
+    notify_parser.add_argument('--theatres', nargs='+',
                                help="Theatres to lookup showtimes for, in order of preference. To find new theatres, go to https://www.amctheatres.com/movie-theatres, search for the theatre you are interested in and click the link to \"Showtimes\" for that theatre. In the URL, after \"movie-theatres/\" there should be a location key and a theatre key, use that portion of the URL for this argument. For example: \"san-francisco/amc-metreon-16\"")
-    notify_parser.add_argument('--offerings', nargs='+', required=True,
+    notify_parser.add_argument('--offerings', nargs='+',
                                help="Theatre formats to lookup (AMC seems to name these offerings). These values can be found by going to amctheatres.com and opening the showtimes for a theatre. There will be an option to select different formats, the default selection is currently \"Premium Offerings\". Selecting a different option will put the key for the format in the URL. For example, selecting \"Dolby Cinema at AMC\" will result in the following value in the URL: \"dolbycinemaatamcprime\"")
+    notify_parser.add_argument('--profiles', default=None,
+                               help='JSON file with a list of subscriber profiles to notify, each with its own "email_to", "theatres" and "offerings" lists (and an optional "name"). Pages shared by several profiles are only fetched once, and each profile is only emailed the new showtimes for its theatres and offerings.')
     notify_parser.add_argument('--log-email-recipients', action='append',
                                help='Email recipients for command logs (sent on any outcome of the command in addition to new notifications). Add as many as necessary.')
+    notify_parser.add_argument('--report-file', default=None,
+                               help='Write a JSON report of the run with per page request latency, bytes, retries, parse and database write times to this file. The report is also attached to the log emails.')
+    notify_parser.add_argument('--prometheus-file', default=None,
+                               help='Write metrics of the run to this file in the Prometheus text format, e.g. for the node_exporter textfile collector.')
+    notify_parser.add_argument('--concurrency', type=positive_int, default=FETCH_CONCURRENCY,
+                               help=f'Maximum number of requests to AMC in flight at once. By default {FETCH_CONCURRENCY}.')
+    notify_parser.add_argument('--parse-workers', type=non_negative_int, default=PARSE_WORKERS,
+                               help=f'Number of processes used to parse pages while others are being fetched. 0 parses them on a single thread instead. By default {PARSE_WORKERS}.')
+    notify_parser.add_argument('--adaptive-schedule', action='store_true', default=False,
+                               help='Only fetch the pages that are due based on how far away their date is and how recently they changed, instead of every page on every run. Near dates are fetched every run and far dates only every few days.')
+    notify_parser.add_argument('--max-requests', type=int, default=None,
+                               help='Maximum number of pages to fetch in this run. With --adaptive-schedule the most overdue pages are fetched first.')
+    notify_parser.add_argument('--requests-per-second', type=float, default=FETCH_RATE,
+                               help=f'Average number of requests per second allowed to AMC. By default {FETCH_RATE}.')
+    notify_parser.add_argument('--notification-backend', default=NOTIFICATION_BACKEND,
+                               help=f'Where to deliver notifications. gmail: Gmail SMTP, logged into with the email sender and password. smtp://host:port, smtps://host:port or smtp+starttls://host:port: any SMTP server, e.g. a local SMTP stub for testing, logged into with the user and password in the URL if given. http(s)://...: a webhook the notifications are posted to as JSON. print: print the notifications instead. By default {NOTIFICATION_BACKEND}.')
+    notify_parser.add_argument('--dry-run', action='store_true', default=False,
+                               help='Print the subject and recipients of each notification instead of delivering it, same as --notification-backend print.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Alert when new showtimes are available.')
+
+    parser.add_argument('--db-file', default='amc_showtimes.db',
+                        help='Customize the location of the SQLLite database file to use. By default its \'amc_showtimes.db\'')
+    parser.add_argument('--http-cache-dir', default='http_cache',
+                        help='Directory to cache fetched pages in so unchanged pages are not downloaded and parsed again. Pass an empty string to disable the cache. By default its \'http_cache\'')
+    parser.add_argument('--record-dir', default=None,
+                        help='Save every page fetched to this directory, to be replayed with "bench replay --pages". Disable the HTTP cache with --http-cache-dir \'\' as well so every page is downloaded in full.')
+    parser.add_argument('--amc-url', default=None,
+                        help='Request pages from this base URL instead of https://www.amctheatres.com, e.g. a local replay server.')
+
+    subparsers = parser.add_subparsers(required=True)
+
+    notify_parser = subparsers.add_parser('notify', help='Check for and notify if there are new showtimes')
+    notify_parser.set_defaults(func=notify)
+    add_notify_arguments(notify_parser)
+
+    serve_parser = subparsers.add_parser('serve', help='Stay running and check for and notify if there are new showtimes on an interval')
+    serve_parser.set_defaults(func=serve)
+    add_notify_arguments(serve_parser)
+    serve_parser.add_argument('--interval-minutes', type=float, default=SERVE_INTERVAL_MINUTES,
+                              help=f'Minutes between the start of each run. By default {SERVE_INTERVAL_MINUTES}.')
 
 
     debug_parser = subparsers.add_parser('debug', help='Debug database')
@@ -190,6 +490,14 @@ if __name__ == "__main__":
                               help='Prints all showtimes in the database using the html email format.')
     debug_parser.add_argument('--pprint-showtimes', action='store_true', default=False,
                               help='Pretty prints all showtimes in the database.')
+    debug_parser.add_argument('--format', choices=['text', 'csv', 'jsonl'], default='text',
+                              help='Output format for --print-showtimes. By default text.')
+    debug_parser.add_argument('--from-date', default=None,
+                              help='Only print showtimes on or after the given date in format 2023-08-05.')
+    debug_parser.add_argument('--to-date', default=None,
+                              help='Only print showtimes on or before the given date in format 2023-08-05.')
+    debug_parser.add_argument('--theatre', default=None,
+                              help='Only print showtimes for the given theatre key.')
     debug_parser.add_argument('--print-showtimes-before', default=None,
                               help='Prints all showtimes in the database with date before the provided datetime in format 2023-08-05 7:34PM')
     debug_parser.add_argument('--delete-showtimes-before', default=None,
@@ -203,10 +511,48 @@ if __name__ == "__main__":
                                help="Theatre to lookup showtimes for, in order of preference. To find new theatres, go to https://www.amctheatres.com/movie-theatres, search for the theatre you are interested in and click the link to \"Showtimes\" for that theatre. In the URL, after \"movie-theatres/\" there should be a location key and a theatre key, use that portion of the URL for this argument. For example: \"san-francisco/amc-metreon-16\"")
     fetch_parser.add_argument('--offering', required=True,
                                help="Theatre format to lookup (AMC seems to name these offerings). These values can be found by going to amctheatres.com and opening the showtimes for a theatre. There will be an option to select different formats, the default selection is currently \"Premium Offerings\". Selecting a different option will put the key for the format in the URL. For example, selecting \"Dolby Cinema at AMC\" will result in the following value in the URL: \"dolbycinemaatamcprime\"")
-
-
-    email_parser = subparsers.add_parser('email', help='Send email with the given parameters through gmail SMTP (used for testing).')
+    fetch_parser.add_argument('--parser', choices=HTML_PARSERS, default=HTML_PARSER,
+                              help=f'Parser backend used to extract showtimes from the page. By default {HTML_PARSER}.')
+
+
+    bench_parser = subparsers.add_parser('bench', help='Run performance benchmarks against a temporary database.')
+    bench_parser.set_defaults(func=bench)
+    bench_parser.add_argument('benchmark', choices=['db', 'index', 'outputs', 'replay', 'startup'],
+                              help='Benchmark to run. db: showtime lookups and purging old records. index: loading and memory use of the in-memory showtime index. outputs: rendering the text and html showtime outputs. replay: full notify runs against a local server replaying recorded pages. startup: cold start time and imports of the commands, exits with an error if a light command is over its target.')
+    bench_parser.add_argument('--showtimes', type=int, default=1000000,
+                              help='Number of synthetic showtimes to generate. By default 1000000.')
+    bench_parser.add_argument('--pages', default=None,
+                              help='replay: Directory of pages recorded with --record-dir to replay. Every theatre and offering recorded is fetched. By default synthetic pages are served instead.')
+    bench_parser.add_argument('--theatres', nargs='+', default=['synthetic/theatre-1', 'synthetic/theatre-2', 'synthetic/theatre-3', 'synthetic/theatre-4'],
+                              help='replay: Theatres to fetch synthetic pages for. By default 4 theatres.')
+    bench_parser.add_argument('--offerings', nargs='+', default=['imax', 'dolby'],
+                              help='replay: Offerings to fetch synthetic pages for. By default 2 offerings.')
+    bench_parser.add_argument('--days', type=int, default=14,
+                              help='replay: How many days in the future to fetch pages for. By default 14.')
+    bench_parser.add_argument('--cycles', type=int, default=3,
+                              help='replay: Number of notify runs. The first run starts with an empty database and HTTP cache, later runs reuse them. By default 3.')
+    bench_parser.add_argument('--latency', type=float, default=0.05,
+                              help='replay: Seconds the server waits before each response. By default 0.05.')
+    bench_parser.add_argument('--error-rate', type=float, default=0.0,
+                              help='replay: Fraction of requests the server fails with a 503. By default 0.')
+    bench_parser.add_argument('--retry-after', type=int, default=None,
+                              help='replay: Fail requests with a 429 asking to retry after this many seconds instead of a 503.')
+    bench_parser.add_argument('--failing-theatres', nargs='+', default=[],
+                              help='replay: Theatres the server fails every request for with a 503.')
+    bench_parser.add_argument('--concurrency', type=positive_int, default=FETCH_CONCURRENCY,
+                              help=f'replay: Maximum number of requests in flight at once. By default {FETCH_CONCURRENCY}.')
+    bench_parser.add_argument('--parse-workers', type=non_negative_int, default=PARSE_WORKERS,
+                              help=f'replay: Number of processes used to parse pages. By default {PARSE_WORKERS}.')
+
+
+    compile_templates_parser = subparsers.add_parser('compile-templates', help='Compile the email templates into the template cache so later runs skip compiling them (done when building the Docker image).')
+    compile_templates_parser.set_defaults(func=compile_templates)
+
+
+    email_parser = subparsers.add_parser('email', help='Send email with the given parameters through gmail SMTP or another notification backend (used for testing).')
     email_parser.set_defaults(func=email)
+    email_parser.add_argument('--notification-backend', default=NOTIFICATION_BACKEND,
+                              help=f'Where to deliver notifications. gmail: Gmail SMTP, logged into with the email sender and password. smtp://host:port, smtps://host:port or smtp+starttls://host:port: any SMTP server, e.g. a local SMTP stub for testing, logged into with the user and password in the URL if given. http(s)://...: a webhook the notifications are posted to as JSON. print: print the notifications instead. By default {NOTIFICATION_BACKEND}.')
     email_parser.add_argument('send_from',
                               help='Email account to send with')
     email_parser.add_argument('smtp_password',
@@ -220,7 +566,12 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    database.init(args.db_file)
+    if args.func in (notify, serve):
+        given = [x is not None for x in [args.email_to, args.theatres, args.offerings]]
+        if any(given) and not all(given):
+            parser.error('--email-to, --theatres and --offerings must be given together')
+        if not any(given) and args.profiles is None:
+            parser.error('either --profiles or --email-to, --theatres and --offerings are required')
 
     args.func(args)
 
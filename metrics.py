@@ -0,0 +1,174 @@
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+
+# Measurements for a single fetched page
+class RequestMetrics(object):
+
+    def __init__(self, target):
+        self.target = target
+        self.status = None
+        self.error = None
+        # Seconds waiting on AMC for the last attempt, not including time waiting on the rate limiter
+        self.latency = None
+        # Size of the response body as sent by AMC (compressed if it was compressed), 0 for a 304
+        self.bytes = 0
+        self.retries = 0
+        self.parse_time = None
+        self.write_time = None
+
+    def to_dict(self):
+        return {
+            'theatre': self.target.theatre,
+            'offering': self.target.offering,
+            'date': self.target.datestr,
+            'status': self.status,
+            'error': self.error,
+            'latency_seconds': self.latency,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'parse_seconds': self.parse_time,
+            'write_seconds': self.write_time,
+        }
+
+
+# Nearest rank percentile of already sorted values
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(values):
+    values = sorted(v for v in values if v is not None)
+    return {
+        'count': len(values),
+        'total': sum(values),
+        'mean': sum(values) / len(values) if len(values) > 0 else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1] if len(values) > 0 else None,
+    }
+
+
+# Collects the measurements of a notify run. Requests are recorded from the fetch and parse threads, so all
+# updates are done under a lock.
+class RunMetrics(object):
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.finished = None
+        self._started_perf = time.perf_counter()
+        self.elapsed = None
+        self.requests = {}
+        # Run level counts, e.g. the number of new showtimes found
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _request(self, target):
+        m = self.requests.get(target)
+        if m is None:
+            m = RequestMetrics(target)
+            self.requests[target] = m
+        return m
+
+    def record_request(self, target, status=None, latency=None, bytes=0, retries=0, error=None):
+        with self._lock:
+            m = self._request(target)
+            m.status = status
+            m.latency = latency
+            m.bytes = bytes
+            m.retries = retries
+            m.error = error
+
+    def record_error(self, target, error):
+        with self._lock:
+            self._request(target).error = error
+
+    def record_parse(self, target, seconds):
+        with self._lock:
+            self._request(target).parse_time = seconds
+
+    def record_write(self, target, seconds):
+        with self._lock:
+            self._request(target).write_time = seconds
+
+    def finish(self, **counters):
+        self.counters.update(counters)
+        self.finished = datetime.now()
+        self.elapsed = time.perf_counter() - self._started_perf
+
+    def report(self):
+        with self._lock:
+            requests = list(self.requests.values())
+
+        return {
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat() if self.finished is not None else None,
+            'elapsed_seconds': self.elapsed,
+            'counters': dict(self.counters),
+            'requests': {
+                'total': len(requests),
+                'failed': len([m for m in requests if m.error is not None]),
+                'not_modified': len([m for m in requests if m.status == 304]),
+                'retries': sum(m.retries for m in requests),
+                'bytes': sum(m.bytes for m in requests),
+            },
+            'latency_seconds': summarize(m.latency for m in requests),
+            'bytes': summarize(m.bytes for m in requests if m.error is None),
+            'parse_seconds': summarize(m.parse_time for m in requests),
+            'write_seconds': summarize(m.write_time for m in requests),
+            'pages': [m.to_dict() for m in requests],
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    # Metrics in the Prometheus text format, e.g. for node_exporter's textfile collector
+    def to_prometheus(self):
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP amc_notifier_{name} {help}')
+            lines.append(f'# TYPE amc_notifier_{name} {kind}')
+            for (labels, value) in samples:
+                if value is not None:
+                    lines.append(f'amc_notifier_{name}{labels} {value}')
+
+        def summary(name, help, s):
+            samples = [(f'{{quantile="{q}"}}', s[k]) for (q, k) in [('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99')]]
+            samples += [('_sum', s['total']), ('_count', s['count'])]
+            metric(name, 'summary', help, samples)
+
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run finished.',
+               [('', self.finished.timestamp() if self.finished is not None else None)])
+        metric('run_duration_seconds', 'gauge', 'Duration of the last run.', [('', report['elapsed_seconds'])])
+        metric('requests', 'gauge', 'Pages requested in the last run.', [('', report['requests']['total'])])
+        metric('failed_requests', 'gauge', 'Pages that failed in the last run.', [('', report['requests']['failed'])])
+        metric('not_modified_requests', 'gauge', 'Pages that were not modified in the last run.', [('', report['requests']['not_modified'])])
+        metric('retries', 'gauge', 'Request retries in the last run.', [('', report['requests']['retries'])])
+        metric('bytes', 'gauge', 'Response bytes received in the last run.', [('', report['requests']['bytes'])])
+        for (name, value) in sorted(report['counters'].items()):
+            metric(name, 'gauge', f'{name.replace("_", " ").capitalize()} in the last run.', [('', value)])
+        summary('request_latency_seconds', 'Latency of page requests in the last run.', report['latency_seconds'])
+        summary('parse_seconds', 'Time spent parsing pages in the last run.', report['parse_seconds'])
+        summary('write_seconds', 'Time spent writing pages to the database in the last run.', report['write_seconds'])
+
+        return '\n'.join(lines) + '\n'
+
+
+# Writes the content to path by replacing it, so readers (like the Prometheus textfile collector) never see a
+# partially written file
+def write_file_atomic(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
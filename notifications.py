@@ -0,0 +1,143 @@
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from urllib.parse import urlparse, unquote
+
+
+# A message to deliver. attachments is a list of (filename, text content) pairs. outbox_id is set once the
+# notification is stored in the outbox.
+class Notification(object):
+
+    def __init__(self, subject, body, recipients, html=False, attachments=None, outbox_id=None):
+        self.subject = subject
+        self.body = body
+        self.recipients = list(recipients)
+        self.html = html
+        self.attachments = list(attachments or [])
+        self.outbox_id = outbox_id
+
+
+def build_email(notification, sender):
+    msg = MIMEText(notification.body, 'html' if notification.html else 'plain')
+    if notification.attachments:
+        text = msg
+        msg = MIMEMultipart()
+        msg.attach(text)
+        for (filename, content) in notification.attachments:
+            attachment = MIMEText(content, 'plain')
+            attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+            msg.attach(attachment)
+    msg['Subject'] = notification.subject
+    msg['From'] = f"AMC Showtime Notifier <{sender}>"
+    msg['To'] = ', '.join(notification.recipients)
+    # Adding this header prevents emails being grouped into threads
+    msg.add_header('X-Entity-Ref-ID', 'null')
+    return msg
+
+
+# Sends notifications as emails through an SMTP server. The connection is opened and logged into on the first
+# message and then reused for every following message until close() is called. username and password may be
+# None for servers that don't need a login, like a local SMTP stub.
+class SmtpBackend(object):
+
+    def __init__(self, host, port, sender, username=None, password=None, ssl=True, starttls=False):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        self.starttls = starttls
+        self._smtp = None
+
+    def _connect(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP_SSL(self.host, self.port) if self.ssl else smtplib.SMTP(self.host, self.port)
+            if self.starttls:
+                smtp.starttls()
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+            self._smtp = smtp
+        return self._smtp
+
+    def send(self, notification):
+        msg = build_email(notification, self.sender).as_string()
+        # The server may have dropped a connection left open since the last message, reconnect once
+        for attempt in range(2):
+            smtp = self._connect()
+            try:
+                smtp.sendmail(self.sender, notification.recipients, msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if attempt > 0:
+                    raise
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+
+# Posts notifications as JSON to a URL, e.g. a chat webhook or a relay to another delivery service
+class WebhookBackend(object):
+
+    def __init__(self, url, timeout=30):
+        # Imported here so that sending email doesn't pay for importing requests
+        import requests
+
+        self.url = url
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def send(self, notification):
+        r = self._session.post(self.url, timeout=self.timeout, json={
+            'subject': notification.subject,
+            'body': notification.body,
+            'html': notification.html,
+            'recipients': notification.recipients,
+            'attachments': [{'filename': f, 'content': c} for (f, c) in notification.attachments],
+        })
+        r.raise_for_status()
+
+    def close(self):
+        pass
+
+
+# Prints the subject and recipients of notifications instead of delivering them
+class PrintBackend(object):
+
+    def send(self, notification):
+        print(f"Dry run, not sending \"{notification.subject}\" to {', '.join(notification.recipients)}")
+
+    def close(self):
+        pass
+
+
+# Creates the backend described by `backend`:
+#   gmail: Gmail SMTP, logged into with `sender` and `password` (make sure to use an App Password).
+#   smtp://host:port, smtps://host:port, smtp+starttls://host:port: any SMTP server, over plain SMTP, SSL or
+#     STARTTLS. Logged into with the user and password in the URL if there are any, otherwise with `sender`
+#     and `password` unless the password is empty.
+#   http://..., https://...: a webhook the notifications are posted to as JSON.
+#   print: prints the notifications instead of delivering them.
+def create_backend(backend, sender, password):
+    if backend == 'gmail':
+        return SmtpBackend('smtp.gmail.com', 465, sender, sender, password)
+    if backend == 'print':
+        return PrintBackend()
+
+    url = urlparse(backend)
+    if url.scheme in ('http', 'https'):
+        return WebhookBackend(backend)
+    if url.scheme in ('smtp', 'smtps', 'smtp+starttls'):
+        ssl = url.scheme == 'smtps'
+        username = unquote(url.username) if url.username else sender
+        password = unquote(url.password) if url.password else password
+        return SmtpBackend(url.hostname, url.port or (465 if ssl else 587 if url.scheme == 'smtp+starttls' else 25),
+                           sender, username, password, ssl=ssl, starttls=url.scheme == 'smtp+starttls')
+
+    raise ValueError(f'Unknown notification backend: {backend}')
@@ -0,0 +1,121 @@
+import json
+import queue
+import threading
+from config import NOTIFICATION_MAX_ATTEMPTS
+from database import database, Outbox
+from datetime import datetime
+from notifications import Notification, PrintBackend
+
+
+# Delivers notifications on a background thread so that a run doesn't wait on the backend, sending them one
+# after another over the backend's single connection. Every notification is stored in the outbox before it is
+# queued and removed once delivered, so notifications that fail, or are still queued when the process exits,
+# are retried by retry_pending() on a later run. Notifications for a PrintBackend are not stored.
+#
+# The outbox is only read and written on the thread calling send() and flush(), the background thread only
+# talks to the backend. Every outbox write is committed right away, so it must not be made inside a transaction
+# that could still be rolled back. Like the database, the dispatcher is created up front and initialized with a
+# backend later.
+class Dispatcher(object):
+
+    def __init__(self, backend=None):
+        self._queue = queue.Queue()
+        self._results = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self.init(backend)
+
+    def init(self, backend):
+        self.backend = backend
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='notifications', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            notification = self._queue.get()
+            try:
+                if notification is None:
+                    # Flushed, don't hold the connection open until the next batch
+                    self.backend.close()
+                    continue
+
+                try:
+                    self.backend.send(notification)
+                    error = None
+                except Exception as e:
+                    error = e
+                    # The connection may be left in a bad state, start over with a new one
+                    self.backend.close()
+
+                with self._lock:
+                    self._results.append((notification, error))
+            finally:
+                self._queue.task_done()
+
+    def _enqueue(self, notification):
+        self._start()
+        self._queue.put(notification)
+
+    def _check_not_in_transaction(self):
+        if database.in_transaction():
+            raise RuntimeError('The outbox must be written outside of a transaction, so that a rollback cannot lose notifications')
+
+    def send(self, notification):
+        # Notifications only printed on a dry run aren't stored, a later real run would otherwise deliver them
+        if isinstance(self.backend, PrintBackend):
+            self._enqueue(notification)
+            return
+
+        self._check_not_in_transaction()
+        row = Outbox.create(created=datetime.now(),
+                            subject=notification.subject,
+                            body=notification.body,
+                            html=notification.html,
+                            recipients=json.dumps(notification.recipients),
+                            attachments=json.dumps(notification.attachments))
+        notification.outbox_id = row.id
+        self._enqueue(notification)
+
+    # Queues every notification left in the outbox by earlier runs. Returns the number queued. Any notifications
+    # still queued from an earlier run that ended early are finished first, so none is queued twice.
+    def retry_pending(self):
+        self.flush()
+        rows = list(Outbox.select().order_by(Outbox.id))
+        for row in rows:
+            self._enqueue(Notification(row.subject, row.body, json.loads(row.recipients), row.html,
+                                       [tuple(a) for a in json.loads(row.attachments)], row.id))
+        return len(rows)
+
+    # Waits for every queued notification to be delivered or fail and updates the outbox with the outcome.
+    # Notifications that failed NOTIFICATION_MAX_ATTEMPTS times are dropped from the outbox. Returns the
+    # (notification, error) pairs of the failed notifications.
+    def flush(self):
+        if self._thread is None:
+            return []
+        self._check_not_in_transaction()
+
+        self._queue.put(None)
+        self._queue.join()
+
+        with self._lock:
+            results = self._results
+            self._results = []
+
+        sent = [n.outbox_id for (n, error) in results if error is None and n.outbox_id is not None]
+        failed = [(n, error) for (n, error) in results if error is not None]
+        with database.atomic():
+            if sent:
+                Outbox.delete().where(Outbox.id.in_(sent)).execute()
+            for (n, error) in failed:
+                if n.outbox_id is None:
+                    continue
+                Outbox.update(attempts=Outbox.attempts + 1, last_error=repr(error)).where(Outbox.id == n.outbox_id).execute()
+            Outbox.delete().where(Outbox.attempts >= NOTIFICATION_MAX_ATTEMPTS).execute()
+
+        return failed
+
+
+dispatcher = Dispatcher(None)
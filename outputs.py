@@ -1,37 +1,76 @@
-import smtplib
+import functools
+import os
+from config import TEMPLATE_CACHE_DIR, HTML_FILM_CACHE_SIZE
 from datetime import datetime
-from email.mime.text import MIMEText
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
-jenv = Environment(
-    loader=FileSystemLoader("templates"),
-    autoescape=select_autoescape()
-)
-
-# Sends an email using Gmail SMTP (make sure to use an App Password)
-def send_email(subject, body, sender, recipients, password, html=False):
-    msg = MIMEText(body, 'html' if html else 'plain')
-    msg['Subject'] = subject
-    msg['From'] = f"AMC Showtime Notifier <{sender}>"
-    msg['To'] = ', '.join(recipients)
-    # Adding this header prevents emails being grouped into threads
-    msg.add_header('X-Entity-Ref-ID', 'null')
-    with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp_server:
-       smtp_server.login(sender, password)
-       smtp_server.sendmail(sender, recipients, msg.as_string())
+from itertools import groupby
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
-def gen_formated_showtimes(showtimes, theatres):
-    by_films = {}
+
+# Bytecode cache of the compiled templates, so a new process doesn't have to parse and compile them again.
+# Failing to write the cache (e.g. when it was precompiled into a read-only image) never fails a render.
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+
+    def dump_bytecode(self, bucket):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+# Created on first use, so that only the commands rendering the html output pay for loading the templates
+@functools.lru_cache(maxsize=None)
+def jinja_env():
+    return Environment(
+        loader=FileSystemLoader(os.path.join(APP_DIR, "templates")),
+        autoescape=select_autoescape(),
+        bytecode_cache=TemplateBytecodeCache(os.path.join(APP_DIR, TEMPLATE_CACHE_DIR))
+    )
+
+
+# Compiles every template into the bytecode cache, e.g. at build time of the Docker image. Returns the names
+# of the templates.
+def precompile_templates():
+    names = jinja_env().list_templates()
+    for name in names:
+        jinja_env().get_template(name)
+    return names
+
+# Groups showtimes by film and then by theatre in a single pass. Returns a dict of film key to a list of
+# (theatre key, showtimes sorted by date) pairs, with theatres in the order of `theatres` and films in the
+# order they first appear. Showtimes at theatres not in `theatres` are left out. Only film_id is read from
+# each showtime, so no film is lazily loaded per showtime.
+def group_showtimes(showtimes, theatres):
     theatre_keys = [t.split('/')[-1] for t in theatres]
-    for fk in set([x.film.key for x in showtimes]):
-        ts = [(t, [s for s in showtimes if s.film.key == fk and s.theatre == t]) for t in theatre_keys]
-        by_films[fk] = [t for t in ts if len(t[1]) > 0]
 
-    body = ""
-    for (k, ts) in by_films.items():
+    by_films = {}
+    for s in showtimes:
+        by_films.setdefault(s.film_id, {}).setdefault(s.theatre, []).append(s)
+
+    grouped = {}
+    for (fk, by_theatre) in by_films.items():
+        ts = [(t, sorted(by_theatre[t], key=lambda x: x.date)) for t in theatre_keys if t in by_theatre]
+        if len(ts) > 0:
+            grouped[fk] = ts
+
+    return grouped
+
+
+# Groups showtimes that are already ordered by film, theatre and date (e.g. by the database) without holding
+# more than one film's showtimes in memory. Yields the same (film key, [(theatre key, showtimes)]) pairs as
+# group_showtimes(...).items().
+def iter_grouped_showtimes(ordered_showtimes):
+    for (fk, film_showtimes) in groupby(ordered_showtimes, key=lambda s: s.film_id):
+        yield (fk, [(t, list(ss)) for (t, ss) in groupby(film_showtimes, key=lambda s: s.theatre)])
+
 
-        body += k + "\n"
+# Yields the text output one film at a time from grouped showtimes
+def iter_formated_showtimes(grouped_showtimes):
+    for (k, ts) in grouped_showtimes:
+
+        body = k + "\n"
         for t in ts:
             body += f"  {t[0]}\n"
             for s in t[1]:
@@ -39,19 +78,42 @@ def gen_formated_showtimes(showtimes, theatres):
                 body += f"    [{ds}] - {s.link}\n"
             body += "\n"
 
-    return body
+        yield body
 
 
-def gen_new_showtimes_html(showtimes, theatres):
-    template = jenv.get_template("email.html.jinja")
+def gen_formated_showtimes(showtimes, theatres):
+    return ''.join(iter_formated_showtimes(group_showtimes(showtimes, theatres).items()))
 
-    by_films = {}
-    theatre_keys = [t.split('/')[-1] for t in theatres]
-    for fk in set([x.film.key for x in showtimes]):
-        ts = [(t, [s for s in showtimes if s.film.key == fk and s.theatre == t]) for t in theatre_keys]
-        by_films[fk] = [t for t in ts if len(t[1]) > 0]
-    return template.render(by_films=by_films,
-                           now=datetime.now().strftime('%Y-%d-%m %H:%M'))
+
+# The header only changes with the minute in `now`, so it is rendered once per minute it is used in
+@functools.lru_cache(maxsize=1)
+def render_html_header(now):
+    return jinja_env().get_template("email_header.html.jinja").render(now=now)
+
+
+@functools.lru_cache(maxsize=1)
+def render_html_footer():
+    return jinja_env().get_template("email_footer.html.jinja").render()
+
+
+# Film blocks are memoized by their content, so a film in the emails of several profiles (or found again on
+# a later run in serve mode) is only rendered once. theatres is a tuple of (theatre key, ((link, date), ...)).
+@functools.lru_cache(maxsize=HTML_FILM_CACHE_SIZE)
+def render_html_film(film_key, title, theatres):
+    return jinja_env().get_template("email_film.html.jinja").render(film_key=film_key, title=title, theatres=theatres)
+
+
+# Yields the html output one film at a time from grouped showtimes
+def iter_showtimes_html(grouped_showtimes):
+    yield render_html_header(datetime.now().strftime('%Y-%d-%m %H:%M'))
+    for (k, ts) in grouped_showtimes:
+        theatres = tuple((t, tuple((s.link, s.date) for s in ss)) for (t, ss) in ts)
+        yield render_html_film(k, ts[0][1][0].film.title, theatres)
+    yield render_html_footer()
+
+
+def gen_new_showtimes_html(showtimes, theatres):
+    return ''.join(iter_showtimes_html(group_showtimes(showtimes, theatres).items()))
 
 
 def gen_formated_film_results(film_results):
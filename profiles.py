@@ -0,0 +1,33 @@
+import json
+
+
+# A group of subscribers that want to be notified of new showtimes for the given theatres and offerings
+class Profile(object):
+
+    def __init__(self, name, email_to, theatres, offerings):
+        self.name = name
+        self.email_to = email_to
+        self.theatres = theatres
+        self.offerings = offerings
+
+    # Whether showtimes found on the page for the target are of interest to this profile
+    def matches(self, target):
+        return target.theatre in self.theatres and target.offering in self.offerings
+
+
+# Loads profiles from a JSON file containing a list of objects with "name", "email_to", "theatres" and
+# "offerings" keys, the last three being lists in the same format as the notify arguments. For example:
+#   [{"name": "dolby", "email_to": ["a@example.com"], "theatres": ["san-francisco/amc-metreon-16"], "offerings": ["dolbycinemaatamcprime"]}]
+def load_profiles(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+
+    profiles = []
+    for (i, p) in enumerate(data):
+        missing = [k for k in ['email_to', 'theatres', 'offerings'] if not p.get(k)]
+        if len(missing) > 0:
+            raise ValueError(f"Profile {p.get('name', i)} in {path} is missing {', '.join(missing)}")
+        profiles.append(Profile(p.get('name', str(i)), p['email_to'], p['theatres'], p['offerings']))
+
+    return profiles
+
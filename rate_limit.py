@@ -0,0 +1,70 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+# Token bucket rate limiter. Tokens refill continuously at `rate` per second up to `burst`, and each
+# request takes one token, blocking until one is available. pause() holds back every request for a while,
+# e.g. when the server asked to retry after some time.
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    # Start over with an empty bucket so requests don't burst out once the pause ends
+                    self._tokens = 0
+                    self._updated = self._paused_until
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + max(0, now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Keeps a separate RateLimiter for every host so that the request budget is enforced per host.
+class HostRateLimiter(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def configure(self, rate, burst=1):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self._limiters = {}
+
+    def _limiter(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(self.rate, self.burst)
+                self._limiters[host] = limiter
+            return limiter
+
+    def acquire(self, url):
+        self._limiter(url).acquire()
+
+    def pause(self, url, seconds):
+        self._limiter(url).pause(seconds)
@@ -0,0 +1,239 @@
+import hashlib
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+
+# Number of navigation links padding each synthetic page, so synthetic pages are roughly as large as real
+# ones (a few hundred KB) and parsing them costs about as much.
+SYNTHETIC_PAGE_FILLER = 2000
+
+
+# Path of the recording for a URL inside `directory`, e.g. for a showtimes page:
+# <directory>/movie-theatres/<location>/<theatre_key>/showtimes/all/<date>/<theatre_key>/<offering>.html
+def recording_path(directory, url):
+    parts = [p for p in urlparse(url).path.split('/') if p not in ('', '.', '..')]
+    return os.path.join(directory, *parts) + '.html'
+
+
+# Saves the body of every page fetched to a directory, so the pages can be served again by a ReplayServer
+# later. Like the HttpCache, the recorder is created up front and initialized with a directory later, a
+# recorder without a directory is disabled.
+class PageRecorder(object):
+
+    def __init__(self, directory=None):
+        self.init(directory)
+
+    def init(self, directory):
+        self.directory = directory or None
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def put(self, url, response):
+        # 304 and error responses have no page worth replaying
+        if not self.enabled or response.status_code != 200:
+            return
+
+        path = recording_path(self.directory, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+# The recorded showtimes pages in `directory` as a dict of (theatre, offering) to the recorded dates, with
+# theatre in the "location/theatre_key" format.
+def recorded_pages(directory):
+    pages = {}
+    root = os.path.join(directory, 'movie-theatres')
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith('.html'):
+                continue
+            parts = os.path.relpath(os.path.join(dirpath, filename[:-len('.html')]), root).split(os.sep)
+            # <location>/<theatre_key>/showtimes/all/<date>/<theatre_key>/<offering>
+            if len(parts) != 7 or parts[2:4] != ['showtimes', 'all']:
+                continue
+            pages.setdefault((parts[0] + '/' + parts[1], parts[6]), []).append(parts[4])
+    for dates in pages.values():
+        dates.sort()
+    return pages
+
+
+# A page that parses like an AMC showtimes page, generated from the page's URL so the same URL always gets
+# the same page
+def synthetic_page(theatre_key, datestr, offering):
+    rng = random.Random(zlib.crc32(f'{theatre_key}/{datestr}/{offering}'.encode('utf-8')))
+
+    body = ['<html><head><title>AMC Showtimes</title></head><body><nav>']
+    for i in range(SYNTHETIC_PAGE_FILLER):
+        body.append(f'<div class="Nav-item"><a href="/nav/{i}"><span>Link {i}</span></a></div>')
+    body.append('</nav><main>')
+    for film in sorted(rng.sample(range(100), rng.randint(5, 15))):
+        body.append(f'<div class="ShowtimesByTheatre-film"><a class="MovieTitleHeader-title" href="/movies/synthetic-film-{film}"><h2>Synthetic Film {film}</h2></a><ul>')
+        for minutes in sorted(rng.sample(range(10 * 60, 23 * 60, 15), rng.randint(1, 6))):
+            time_str = f'{(minutes // 60 - 1) % 12 + 1}:{minutes % 60:02d}{"pm" if minutes >= 12 * 60 else "am"}'
+            body.append(f'<li class="Showtime"><a href="/showtimes/all/{datestr}/{theatre_key}/{offering}/{film}-{minutes}">{time_str}</a></li>')
+        body.append('</ul></div>')
+    body.append('</main></body></html>')
+    return ''.join(body).encode('utf-8')
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.counters.get_lock():
+            server.counters[0] += 1
+
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        failing = len(parts) > 2 and f'{parts[1]}/{parts[2]}' in server.failing_theatres
+        if failing or (server.error_rate > 0 and server.rng.random() < server.error_rate):
+            with server.counters.get_lock():
+                server.counters[1] += 1
+            if server.retry_after is not None and not failing:
+                self._respond(429, b'Too Many Requests', {'Retry-After': str(server.retry_after)})
+            else:
+                self._respond(503, b'Service Unavailable')
+            return
+
+        body = server.page(self.path)
+        if body is None:
+            self._respond(404, b'Not Found')
+            return
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self._respond(304, b'', {'ETag': etag})
+            return
+
+        with server.counters.get_lock():
+            server.counters[2] += len(body)
+        self._respond(200, body, {'ETag': etag, 'Content-Type': 'text/html; charset=utf-8'})
+
+    def _respond(self, status, body, headers={}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ReplayHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, directory, latency, error_rate, retry_after, failing_theatres, seed, counters):
+        super().__init__(address, _ReplayHandler)
+        self.directory = directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.failing_theatres = set(failing_theatres)
+        self.rng = random.Random(seed)
+        self.counters = counters
+        self.pages = recorded_pages(directory) if directory else {}
+
+    # The body to serve for a request path. A recording of the exact page is served if there is one, otherwise
+    # a recording of the same theatre and offering on another date, so recordings can be replayed for any date.
+    # Without any recordings every page is synthetic.
+    def page(self, path):
+        parts = [p for p in urlparse(path).path.split('/') if p]
+        if len(parts) != 8 or parts[0] != 'movie-theatres' or parts[3:5] != ['showtimes', 'all']:
+            return None
+        (location, theatre_key, datestr, offering) = (parts[1], parts[2], parts[5], parts[7])
+
+        if not self.pages:
+            return synthetic_page(theatre_key, datestr, offering)
+
+        dates = self.pages.get((location + '/' + theatre_key, offering))
+        if not dates:
+            return None
+        if datestr not in dates:
+            datestr = dates[zlib.crc32(datestr.encode('utf-8')) % len(dates)]
+        with open(os.path.join(self.directory, 'movie-theatres', location, theatre_key, 'showtimes', 'all', datestr, theatre_key, offering + '.html'), 'rb') as f:
+            return f.read()
+
+
+def _serve(directory, latency, error_rate, retry_after, failing_theatres, seed, counters, ports):
+    server = _ReplayHTTPServer(('127.0.0.1', 0), directory, latency, error_rate, retry_after, failing_theatres, seed, counters)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+# Local HTTP server that serves recorded (or synthetic) AMC showtimes pages in place of amctheatres.com.
+# Every response is delayed by `latency` seconds and `error_rate` of the requests fail with a 503, or with a
+# 429 asking to retry after `retry_after` seconds if it's given. Every request for `failing_theatres` (in the
+# "location/theatre_key" format) fails with a 503. Pages are served with an ETag so conditional requests get a
+# 304 when the page has not changed. The server runs in its own process so it does not take CPU time or memory
+# from the process being benchmarked.
+class ReplayServer(object):
+
+    def __init__(self, directory=None, latency=0.0, error_rate=0.0, retry_after=None, failing_theatres=(), seed=0):
+        self.directory = directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.failing_theatres = list(failing_theatres)
+        self.seed = seed
+        self.process = None
+        self.url = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        # Requests, error responses and body bytes sent
+        self._counters = context.Array('q', 3)
+        ports = context.Queue()
+        self.process = context.Process(target=_serve,
+                                       args=(self.directory, self.latency, self.error_rate, self.retry_after, self.failing_theatres, self.seed, self._counters, ports),
+                                       daemon=True)
+        self.process.start()
+        self.url = f'http://127.0.0.1:{ports.get(timeout=30)}'
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def requests(self):
+        return self._counters[0]
+
+    @property
+    def errors(self):
+        return self._counters[1]
+
+    @property
+    def bytes_sent(self):
+        return self._counters[2]
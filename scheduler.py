@@ -0,0 +1,73 @@
+from config import SCAN_INTERVALS, SCAN_RECENT_CHANGE_HOURS
+from database import ScanState
+from datetime import datetime, timedelta
+
+
+# How long to wait between fetches of a page for the given date. Near dates are polled often, far dates
+# rarely, and pages that changed recently are polled more often than their distance alone would suggest.
+def poll_interval(date, now, last_changed=None):
+    days_away = (date - now.date()).days
+    hours = SCAN_INTERVALS[-1][1]
+    for (max_days, interval_hours) in SCAN_INTERVALS:
+        if max_days is None or days_away <= max_days:
+            hours = interval_hours
+            break
+
+    if last_changed is not None and now - last_changed < timedelta(hours=SCAN_RECENT_CHANGE_HOURS):
+        hours = hours / 4
+
+    return timedelta(hours=hours)
+
+
+# Filters the targets down to the ones due to be fetched, most overdue first. Targets that have never been
+# fetched are always due and come first. At most `max_requests` targets are returned if it's given.
+def due_targets(targets, now=None, max_requests=None):
+    if now is None:
+        now = datetime.now()
+    if len(targets) == 0:
+        return []
+
+    dates = [t.datestr for t in targets]
+    q = ScanState.select().where(ScanState.date.between(min(dates), max(dates)))
+    states = {(s.theatre, s.offering, s.date): s for s in q}
+
+    due = []
+    for target in targets:
+        state = states.get((target.theatre, target.offering, target.datestr))
+        date = datetime.strptime(target.datestr, '%Y-%m-%d').date()
+        if state is None:
+            due.append((float('inf'), date, target))
+            continue
+
+        interval = poll_interval(date, now, state.last_changed)
+        elapsed = now - state.last_checked
+        if elapsed >= interval:
+            overdue = elapsed / interval if interval > timedelta(0) else float('inf')
+            due.append((overdue, date, target))
+
+    # Most overdue first, then the nearest dates
+    due.sort(key=lambda x: (-x[0], x[1]))
+    targets = [x[2] for x in due]
+    if max_requests is not None:
+        targets = targets[:max_requests]
+    return targets
+
+
+# Records that the page for the target was fetched at `now`, and whether it changed since it was last fetched
+def record_scan(target, changed, now=None):
+    if now is None:
+        now = datetime.now()
+
+    update = {ScanState.last_checked: now}
+    if changed:
+        update[ScanState.last_changed] = now
+
+    (ScanState
+     .insert(theatre=target.theatre,
+             offering=target.offering,
+             date=target.datestr,
+             last_checked=now,
+             last_changed=None)
+     .on_conflict(conflict_target=[ScanState.theatre, ScanState.offering, ScanState.date],
+                  update=update)
+     .execute())
@@ -0,0 +1,19 @@
+import os
+import pytest
+import sys
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+
+# A migrated database in a temporary directory, connected for the test without holding a transaction open
+@pytest.fixture
+def db(tmp_path):
+    from database import database, migrate
+
+    database.init(str(tmp_path / 'test.db'))
+    with database.connection_context():
+        migrate()
+        yield database
+    database.init(None)
@@ -0,0 +1,194 @@
+import circuit_breaker
+import fetch_showtimes
+import pytest
+import requests
+from circuit_breaker import CircuitBreaker, RetryBudget, TheatreCircuitBreakers, TheatreRetryBudgets
+from config import FETCH_MAX_RETRY_AFTER
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from fetch_showtimes import ThrottledError, _give_up, _retry_wait, parse_retry_after
+
+
+# Replaces time.monotonic for the circuit breakers with a clock that only moves when told to
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, 'monotonic', clock)
+    return clock
+
+
+def open_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=60)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 1
+    assert not breaker.allow()
+
+
+def test_half_open_breaker_lets_a_single_probe_through(clock):
+    breaker = open_breaker()
+
+    clock.advance(59)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = open_breaker()
+
+    clock.advance(60)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 2
+
+    clock.advance(59)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+
+
+def test_in_flight_failures_dont_extend_the_open_breaker(clock):
+    breaker = open_breaker()
+
+    # Requests that were already in flight when the breaker opened fail later
+    clock.advance(30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.trips == 1
+
+    clock.advance(30)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_ignored_probe_lets_another_request_probe(clock):
+    breaker = open_breaker()
+
+    clock.advance(60)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_ignored()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_breakers_are_kept_per_theatre(clock):
+    breakers = TheatreCircuitBreakers(failure_threshold=1, reset_seconds=60)
+    breakers.get('loc/amc-a').record_failure()
+
+    assert breakers.get('loc/amc-a') is breakers.get('loc/amc-a')
+    assert not breakers.get('loc/amc-a').allow()
+    assert breakers.get('loc/amc-b').allow()
+    assert breakers.tripped() == ['loc/amc-a']
+
+
+def test_retry_budget_allows_a_minimum_plus_a_ratio_of_requests():
+    budget = RetryBudget(ratio=0.5, minimum=1)
+    assert budget.available()
+    budget.record_retry()
+    assert not budget.available()
+
+    budget.record_request()
+    budget.record_request()
+    assert budget.available()
+    budget.record_retry()
+    assert not budget.available()
+
+    budget.reset()
+    assert budget.available()
+
+
+def test_retry_budgets_are_kept_per_theatre():
+    budgets = TheatreRetryBudgets(ratio=0, minimum=2)
+    budgets.get('loc/amc-dead').record_retry()
+    budgets.get('loc/amc-dead').record_retry()
+
+    assert not budgets.get('loc/amc-dead').available()
+    assert budgets.get('loc/amc-a').available()
+
+    budgets.reset()
+    assert budgets.get('loc/amc-dead').available()
+
+
+def throttled(retry_after):
+    response = requests.Response()
+    response.status_code = 429
+    response.url = 'http://localhost/page'
+    return ThrottledError(response, retry_after)
+
+
+def test_give_up_once_the_theatre_budget_is_used(monkeypatch):
+    budget = RetryBudget(ratio=0, minimum=1)
+    monkeypatch.setattr(fetch_showtimes.last_request, 'retry_budget', budget, raising=False)
+
+    error = requests.exceptions.ConnectionError()
+    assert not _give_up(error)
+    budget.record_retry()
+    assert _give_up(error)
+
+
+def test_give_up_when_asked_to_retry_too_late(monkeypatch):
+    monkeypatch.setattr(fetch_showtimes.last_request, 'retry_budget', RetryBudget(ratio=0, minimum=10), raising=False)
+
+    assert not _give_up(throttled(FETCH_MAX_RETRY_AFTER))
+    assert _give_up(throttled(FETCH_MAX_RETRY_AFTER + 1))
+
+
+def test_retry_wait_backs_off_except_after_a_retry_after():
+    wait = _retry_wait(2)
+    next(wait)
+    error = requests.exceptions.ConnectionError()
+
+    assert wait.send(error) == 2
+    # The rate limiter already waits out the Retry-After
+    assert wait.send(throttled(5)) == 0
+    assert wait.send(error) == 4
+    assert wait.send(throttled(None)) == 8
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after(' 120 ') == 120
+    assert parse_retry_after('soon') is None
+
+    in_30s = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 <= parse_retry_after(in_30s) <= 30
+    an_hour_ago = format_datetime(datetime.now(timezone.utc) - timedelta(hours=1), usegmt=True)
+    assert parse_retry_after(an_hour_ago) == 0
@@ -0,0 +1,107 @@
+import pytest
+import socketserver
+import threading
+from database import Outbox
+from datetime import datetime
+from notifications import Notification, PrintBackend, SmtpBackend
+from outbox import Dispatcher
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost SMTP stub')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip().upper()
+            if command.startswith('DATA'):
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+    def reply(self, line):
+        self.wfile.write(line.encode('utf-8') + b'\r\n')
+
+
+# Local SMTP server that accepts every message, counting the connections made and the messages received
+class SmtpStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SmtpHandler)
+        self.connections = 0
+        self.messages = 0
+
+
+@pytest.fixture
+def smtp_stub():
+    server = SmtpStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def smtp_backend(port):
+    return SmtpBackend('127.0.0.1', port, 'notifier@localhost', ssl=False)
+
+
+def notification(subject):
+    return Notification(subject, 'Body', ['me@localhost'])
+
+
+def test_notifications_are_sent_over_a_single_connection(db, smtp_stub):
+    dispatcher = Dispatcher(smtp_backend(smtp_stub.server_address[1]))
+    for i in range(3):
+        dispatcher.send(notification(f'Notification {i}'))
+
+    assert dispatcher.flush() == []
+    assert smtp_stub.messages == 3
+    assert smtp_stub.connections == 1
+    assert Outbox.select().count() == 0
+
+
+def test_failed_notifications_are_retried_by_the_next_run(db, smtp_stub):
+    # Nothing listens on the port of a server that was just closed
+    closed = SmtpStub()
+    closed_port = closed.server_address[1]
+    closed.server_close()
+
+    dispatcher = Dispatcher(smtp_backend(closed_port))
+    dispatcher.send(notification('Retried'))
+    failed = dispatcher.flush()
+
+    assert [n.subject for (n, error) in failed] == ['Retried']
+    assert Outbox.get().attempts == 1
+
+    dispatcher = Dispatcher(smtp_backend(smtp_stub.server_address[1]))
+    assert dispatcher.retry_pending() == 1
+    assert dispatcher.flush() == []
+    assert smtp_stub.messages == 1
+    assert Outbox.select().count() == 0
+
+
+def test_dry_runs_dont_touch_the_outbox(db, capsys):
+    Outbox.create(created=datetime.now(), subject='Undelivered', body='Body', html=False,
+                  recipients='["me@localhost"]', attachments='[]', attempts=1)
+
+    dispatcher = Dispatcher(PrintBackend())
+    dispatcher.send(notification('Dry run'))
+    # Not stored even before it's printed, so a dry run ending early can't leave it for a real run to deliver
+    assert [row.subject for row in Outbox.select()] == ['Undelivered']
+
+    assert dispatcher.flush() == []
+    assert [row.subject for row in Outbox.select()] == ['Undelivered']
+    assert 'Dry run, not sending "Dry run"' in capsys.readouterr().out
@@ -0,0 +1,72 @@
+import os
+import pytest
+from config import HTML_PARSERS
+from fetch_showtimes import parse_showtimes
+from replay import synthetic_page
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Saved showtimes pages as (fixture file, theatre key, date, offering)
+FIXTURES = [
+    ('showtimes-multi-class.html', 'amc-metreon-16', '2024-03-01', 'dolbycinemaatamcprime'),
+    ('showtimes-unavailable.html', 'amc-eastridge-15', '2024-03-02', 'dolbycinemaatamcprime'),
+]
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def parse_with_every_parser(content, theatre_key, datestr, offering):
+    return {p: [f.to_dict() for f in parse_showtimes(content, theatre_key, datestr, offering, p)] for p in HTML_PARSERS}
+
+
+# (film key, showtime time) pairs of the showtimes in the to_dict() form of parsed films
+def showtime_times(films):
+    return [(f['key'], s['datetime'][11:16]) for f in films for s in f['showtimes']]
+
+
+@pytest.mark.parametrize('fixture', FIXTURES, ids=[f[0] for f in FIXTURES])
+def test_parsers_agree_on_fixtures(fixture):
+    (name, theatre_key, datestr, offering) = fixture
+    results = parse_with_every_parser(read_fixture(name), theatre_key, datestr, offering)
+
+    expected = results['html5lib']
+    assert len(expected) > 0
+    for (parser, films) in results.items():
+        assert films == expected, parser
+
+
+def test_films_with_several_classes():
+    results = parse_with_every_parser(read_fixture('showtimes-multi-class.html'), 'amc-metreon-16', '2024-03-01', 'dolbycinemaatamcprime')
+
+    for (parser, films) in results.items():
+        assert showtime_times(films) == [
+            ('dune-part-two-67990', '11:00'),
+            ('dune-part-two-67990', '15:15'),
+            ('dune-part-two-67990', '19:30'),
+            # The 1:00pm showtime is for another offering
+            ('kung-fu-panda-4-72462', '10:45'),
+            ('ghostbusters-frozen-empire-71361', '21:50'),
+        ], parser
+
+
+def test_unavailable_showtimes_are_skipped():
+    results = parse_with_every_parser(read_fixture('showtimes-unavailable.html'), 'amc-eastridge-15', '2024-03-02', 'dolbycinemaatamcprime')
+
+    for (parser, films) in results.items():
+        # Civil War only has disabled and "available soon" showtimes, so it's left out
+        assert showtime_times(films) == [
+            ('dune-part-two-67990', '16:00'),
+            ('godzilla-x-kong-the-new-empire-71376', '18:45'),
+        ], parser
+
+
+def test_parsers_agree_on_synthetic_page():
+    results = parse_with_every_parser(synthetic_page('amc-metreon-16', '2024-03-01', 'imax'), 'amc-metreon-16', '2024-03-01', 'imax')
+
+    assert len(results['html5lib']) > 0
+    for (parser, films) in results.items():
+        assert films == results['html5lib'], parser
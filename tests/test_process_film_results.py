@@ -0,0 +1,39 @@
+import sqlite3
+from database import Showtime
+from datetime import datetime
+from fetch_showtimes import FilmResult, ShowtimeResult, process_film_results
+from showtime_index import ShowtimeIndex
+
+
+def film_result(link):
+    return FilmResult('dune-part-two-67990', 'Dune: Part Two', [
+        ShowtimeResult(datetime(2024, 3, 1, 19, 30), 'amc-metreon-16', link),
+        ShowtimeResult(datetime(2024, 3, 1, 22, 0), 'amc-metreon-16', 'https://www.amctheatres.com/showtimes/2'),
+    ])
+
+
+def test_new_showtimes_are_inserted(db):
+    index = ShowtimeIndex().load()
+    new = process_film_results([film_result('https://www.amctheatres.com/showtimes/1')], index)
+
+    assert len(new.films) == 1
+    assert len(new.showtimes) == 2
+    assert Showtime.select().count() == 2
+    assert len(index) == 2
+
+
+def test_rows_written_after_the_index_loaded_dont_fail_the_run(db):
+    index = ShowtimeIndex().load()
+
+    # Another connection writes the same film and showtime with another link after the index was loaded
+    other = sqlite3.connect(db.database)
+    other.execute('INSERT INTO "film" VALUES (?, ?)', ('dune-part-two-67990', 'Dune: Part Two'))
+    other.execute('INSERT INTO "showtime" ("film_id", "theatre", "date", "link") VALUES (?, ?, ?, ?)',
+                  ('dune-part-two-67990', 'amc-metreon-16', '2024-03-01 19:30:00', 'https://www.amctheatres.com/showtimes/old'))
+    other.commit()
+    other.close()
+
+    process_film_results([film_result('https://www.amctheatres.com/showtimes/1')], index)
+
+    assert Showtime.select().count() == 2
+    assert Showtime.get(Showtime.date == datetime(2024, 3, 1, 19, 30)).link == 'https://www.amctheatres.com/showtimes/1'
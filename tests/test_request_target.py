@@ -0,0 +1,40 @@
+import fetch_showtimes
+import pytest
+from config import FETCH_RATE, FETCH_BURST
+from fetch_showtimes import build_fetch_targets, fetch_targets
+from replay import ReplayServer
+
+
+@pytest.fixture
+def server():
+    with ReplayServer() as server:
+        fetch_showtimes.set_showtimes_base_url(server.url)
+        # The local server doesn't need requests spaced out like AMC does
+        fetch_showtimes.rate_limiter.configure(1000, 1000)
+        yield server
+    fetch_showtimes.rate_limiter.configure(FETCH_RATE, FETCH_BURST)
+    fetch_showtimes.set_showtimes_base_url(None)
+    fetch_showtimes.http_cache.init(None)
+
+
+def run(cache_dir):
+    fetch_showtimes.http_cache.init(cache_dir)
+    targets = build_fetch_targets(1, ['synthetic/theatre-1'], ['imax'])
+    return fetch_targets(targets, lambda err: None, concurrency=1, parse_workers=0).metrics.report()['requests']
+
+
+# Pages fingerprinted by a run without the cache are cached by the next run with it, so they get a 304 after that
+def test_fingerprinted_pages_are_cached(db, server, tmp_path):
+    cache_dir = str(tmp_path / 'http_cache')
+
+    assert run(None)['not_modified'] == 0
+    assert run(cache_dir)['not_modified'] == 0
+    assert run(cache_dir)['not_modified'] == 1
+
+
+def test_fetch_targets_needs_a_fetch_thread():
+    targets = build_fetch_targets(1, ['synthetic/theatre-1'], ['imax'])
+    with pytest.raises(ValueError):
+        fetch_targets(targets, lambda err: None, concurrency=0)
+    with pytest.raises(ValueError):
+        fetch_targets(targets, lambda err: None, parse_workers=-1)
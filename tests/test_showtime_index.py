@@ -0,0 +1,58 @@
+import tracemalloc
+from benchmarks import _generate_showtimes
+from database import database, Film, Showtime
+from datetime import datetime
+from showtime_index import ShowtimeIndex
+
+
+LINK = 'https://www.amctheatres.com/showtimes/1'
+
+DATES = [
+    datetime(2024, 3, 1, 19, 30),
+    datetime(2024, 3, 10, 2, 30),
+    datetime(2024, 11, 3, 1, 45),
+    datetime(2024, 12, 31, 23, 59),
+    datetime(2025, 1, 1, 0, 0),
+]
+
+
+def test_diff(db):
+    index = ShowtimeIndex()
+    index.add('dune-part-two-67990', 'amc-metreon-16', DATES[0], LINK)
+
+    assert index.diff('dune-part-two-67990', 'amc-metreon-16', DATES[0], LINK) == ShowtimeIndex.UNCHANGED
+    assert index.diff('dune-part-two-67990', 'amc-metreon-16', DATES[0], LINK + '0') == ShowtimeIndex.CHANGED
+    assert index.diff('dune-part-two-67990', 'amc-metreon-16', DATES[1], LINK) == ShowtimeIndex.NEW
+    assert index.diff('dune-part-two-67990', 'amc-eastridge-15', DATES[0], LINK) == ShowtimeIndex.NEW
+    assert index.diff('civil-war-72286', 'amc-metreon-16', DATES[0], LINK) == ShowtimeIndex.NEW
+
+
+# Showtimes loaded from the database are packed with the minute from SQLite's strftime('%s'), and diffed
+# showtimes with the minute from calendar.timegm, both have to agree
+def test_load_packs_the_same_minutes_as_diff(db):
+    Film.create(key='dune-part-two-67990', title='Dune: Part Two')
+    for dt in DATES:
+        Showtime.create(film='dune-part-two-67990', theatre='amc-metreon-16', date=dt, link=LINK)
+
+    index = ShowtimeIndex().load()
+
+    assert len(index) == len(DATES)
+    for dt in DATES:
+        (seconds,) = database.execute_sql('SELECT CAST(strftime(\'%s\', ?) AS INTEGER)', (dt.strftime('%Y-%m-%d %H:%M:%S'),)).fetchone()
+        assert ShowtimeIndex._minute(dt) == seconds // 60
+        assert index.diff('dune-part-two-67990', 'amc-metreon-16', dt, LINK) == ShowtimeIndex.UNCHANGED
+
+
+# The class documents about 110 bytes per showtime for a million showtimes and 2000 films. Scaled down 64
+# times the showtimes fill the dict's hash table as much as a million do, and the films take as large a share.
+def test_memory_per_showtime(db):
+    _generate_showtimes(1000000 // 64, 2000 // 64, 0)
+
+    tracemalloc.start()
+    try:
+        index = ShowtimeIndex().load()
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    assert memory / len(index) < 110 * 1.1